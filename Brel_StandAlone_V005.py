@@ -3,7 +3,7 @@
 # https://www.brel-home.nl/nl/pro/producten/smart-home/716/hub-032
 # To debug for Domoticz made by Salmr199
 # No warranty, it comes as it comes
-# Requires: pip install pycryptodome
+# Requires: brel_transport.py and brel_crypto.py next to this script (pycryptodome is used when installed)
 
 # To retreive the KEY from your Brel Hub:
 # Get the KEY by quickly tapping 5 times on "Version 1.x.x(x)" in your Brel SmartPhone app. 
@@ -14,39 +14,103 @@ import socket
 import json
 import time
 import threading
-import binascii
 from datetime import datetime
-from Crypto.Cipher import AES
+from brel_crypto import derive_access_token
+from brel_transport import AdaptiveLimiter, RttEstimator, RETRIES
 import re
 import ipaddress
+import select
+import argparse
+import contextlib
+import os
+import sys
 
 MULTICAST_IP = "238.0.0.18"
 UNICAST_PORT = 32100
 MULTICAST_PORT = 32101
 SUBNET_IP = "192.168.1"
+RECV_BUFSIZE = 65535  # GetDeviceList replies of large installations exceed 4 kB
 KEY  = "XXXXXXXXXXXXXXXX" #Key must be exactly 16 bytes
 
 # ---------------- Network scan for Brel Hubs ----------------
-def scan_for_brel_hub(subnet=SUBNET_IP + ".0/24", timeout=0.5):
-    """Scan local network for a Brel Hub, return first IP found"""
-    print(f"🔍 Scanning network {subnet} for Brel Hubs...")
-    for ip in ipaddress.IPv4Network(subnet):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(timeout)
-        try:
-            msg = json.dumps({"msgType": "GetDeviceList", "msgID": "1010"}).encode()
-            sock.sendto(msg, (str(ip), UNICAST_PORT))
-            data, addr = sock.recvfrom(2048)
-            response = json.loads(data.decode())
+def _bind_interface(sock, interface):
+    """Bind sock to a local IPv4 address or (Linux) an interface name"""
+    try:
+        ipaddress.IPv4Address(interface)
+        sock.bind((interface, 0))
+    except ValueError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+
+
+def sweep_for_brel_hubs(subnet=SUBNET_IP + ".0/24", deadline=3.0, interface=None, rate=2000):
+    """Probe every host of subnet from one socket, return [(ip, rtt_ms)] of all hubs that answer
+    before deadline seconds. rate limits probes per second so large CIDRs do not flood the LAN."""
+    network = ipaddress.IPv4Network(subnet, strict=False)
+    print(f"🔍 Sweeping {network} ({network.num_addresses} addresses) for Brel Hubs...")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if interface:
+        _bind_interface(sock, interface)
+    sock.setblocking(False)
+    probe = json.dumps({"msgType": "GetDeviceList", "msgID": "1010"}).encode()
+    hosts = network.hosts() if network.num_addresses > 2 else iter(network)
+    sent = {}
+    found = {}
+    pending = None  # host whose probe hit a full send buffer, retried first
+    start = time.monotonic()
+    end = None
+    try:
+        while True:
+            now = time.monotonic()
+            # Send as many probes as the rate budget allows
+            if hosts is not None:
+                budget = int((now - start) * rate) + 1 - len(sent)
+                while budget > 0:
+                    ip, pending = (next(hosts, None), None) if pending is None else (pending, None)
+                    if ip is None:
+                        hosts = None
+                        end = now + deadline
+                        break
+                    try:
+                        sock.sendto(probe, (str(ip), UNICAST_PORT))
+                    except BlockingIOError:
+                        pending = ip
+                        break
+                    except OSError:
+                        pass
+                    sent[str(ip)] = time.monotonic()
+                    budget -= 1
+            if end is not None and now >= end:
+                break
+            wait = 0.01 if hosts is not None else end - now
+            readable, _, _ = select.select([sock], [], [], max(wait, 0))
+            if not readable:
+                continue
+            try:
+                data, addr = sock.recvfrom(RECV_BUFSIZE)
+            except OSError:
+                continue
+            ip = addr[0]
+            if ip in found or ip not in sent:
+                continue
+            try:
+                response = json.loads(data.decode())
+            except ValueError:
+                continue
             if "data" in response:
-                print(f"Found Brel Hub at {ip}")
-                return str(ip)
-        except:
-            pass
-        finally:
-            sock.close()
-    print("No Brel Hubs found on the network")
-    return None
+                found[ip] = round((time.monotonic() - sent[ip]) * 1000, 1)
+                print(f"Found Brel Hub at {ip} ({found[ip]} ms)")
+    finally:
+        sock.close()
+    if not found:
+        print("No Brel Hubs found on the network")
+    return sorted(found.items(), key=lambda item: item[1])
+
+
+def scan_for_brel_hub(subnet=SUBNET_IP + ".0/24", timeout=0.5, interface=None):
+    """Scan local network for a Brel Hub, return the fastest IP found"""
+    hubs = sweep_for_brel_hubs(subnet, deadline=max(timeout, 1.0), interface=interface)
+    return hubs[0][0] if hubs else None
       
 # ---------------- BrelHub class ----------------
 class BrelHub:
@@ -56,6 +120,9 @@ class BrelHub:
         self.secret = secret
         self.devices = {}
         self.access_token = None
+        self.limiter = AdaptiveLimiter()
+        self.rtt = RttEstimator()
+        self.retries = dict(RETRIES)
 
     # ---------- Communication helpers ----------
     def _timestamp(self, mac=None):
@@ -65,18 +132,39 @@ class BrelHub:
         ms = int((datetime.utcnow() - datetime(1970,1,1)).total_seconds()*1000)
         return f"{base}{ms}"
 
-    def _send_request(self, payload):
+    def _send_request(self, payload, timeout=5, retries=None):
+        msg_type = payload["msgType"]
+        if retries is None:
+            retries = self.retries.get(msg_type, 0)
+        raw = bytes(json.dumps(payload), 'utf8')
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5)
-        sock.sendto(bytes(json.dumps(payload),'utf8'), (self.host, UNICAST_PORT))
+        deadline = time.monotonic() + timeout
         try:
-            reply, addr = sock.recvfrom(2048)
-            return json.loads(reply.decode())
-        except socket.timeout:
+            for attempt in range(retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining if attempt == retries else min(self.rtt.timeout(attempt), remaining))
+                sent = time.monotonic()
+                sock.sendto(raw, (self.host, UNICAST_PORT))
+                try:
+                    reply, _ = sock.recvfrom(RECV_BUFSIZE)
+                except socket.timeout:
+                    self._record_attempt(payload, attempt, "timeout", None)
+                    continue
+                rtt = time.monotonic() - sent
+                if attempt == 0:
+                    self.rtt.sample(rtt)
+                self._record_attempt(payload, attempt, "ok", rtt)
+                return json.loads(reply.decode())
             print("Timeout: No reply from Brel hub")
             return None
         finally:
             sock.close()
+
+    def _record_attempt(self, payload, attempt, outcome, rtt):
+        if outcome != "ok":
+            print(f"  {payload['msgType']} {payload.get('mac', '')} attempt {attempt + 1}: {outcome}")
             
     def mac_from_selection(self, selection):
         try:
@@ -125,10 +213,7 @@ class BrelHub:
             print("Using pre-generated secret token")
             return self.access_token
         try:
-            token = self.gateway["token"].encode()
-            cipher = AES.new(self.key, AES.MODE_ECB)
-            encrypted = cipher.encrypt(token)
-            self.access_token = binascii.hexlify(encrypted).decode().upper()
+            self.access_token = derive_access_token(self.key, self.gateway["token"])
             print(f"AccessToken generated: {self.access_token}")
             return self.access_token
         except Exception as e:
@@ -175,24 +260,47 @@ class BrelHub:
         print("✔ Command acknowledged:", ack)
         return ack
         
-    def poll_all_devices(self):
+    def poll_all_devices(self, timeout=3):
         print("\nPolling all devices...")
+        queue = list(self.device_index)
         results = {}
-        for mac in self.device_index:
-            msg = {
-                "msgType": "ReadDevice",
-                "mac": mac,
-                "deviceType": self.devices[mac]["deviceType"],
-                "msgID": self._timestamp(mac)
-            }
-            data = self._send_request(msg)
-            if data:
-                results[mac] = data
-                print(f"Polled {mac}")
-            else:
-                print(f"Failed to poll {mac}")
-            time.sleep(0.1)  # be nice to the hub
-        return results
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    mac = queue.pop(0)
+                msg = {
+                    "msgType": "ReadDevice",
+                    "mac": mac,
+                    "deviceType": self.devices[mac]["deviceType"],
+                    "msgID": self._timestamp(mac)
+                }
+                self.limiter.acquire()
+                data = None
+                try:
+                    data = self._send_request(msg, timeout=timeout)
+                finally:
+                    self.limiter.release(data is not None)
+                with lock:
+                    if data:
+                        results[mac] = data
+                        print(f"Polled {mac}")
+                    else:
+                        print(f"Failed to poll {mac}")
+
+        start = time.monotonic()
+        workers = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(min(len(queue), self.limiter.max_window))]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        print(f"Polled {len(results)}/{len(self.device_index)} devices in {time.monotonic() - start:.2f}s")
+        # Keep the table in hub order rather than reply order
+        return {mac: results[mac] for mac in self.device_index if mac in results}
         
     def print_device_table(self, results):
         if not results:
@@ -264,12 +372,14 @@ class BrelHub:
 # ---------------- Multicast listener ----------------
 def listen_multicast(callback):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
     sock.bind(("", MULTICAST_PORT))
     mreq = socket.inet_aton(MULTICAST_IP) + socket.inet_aton("0.0.0.0")
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
     print("\nListening for Brel Report messages...\n")
     while True:
-        data, addr = sock.recvfrom(2048)
+        data, addr = sock.recvfrom(RECV_BUFSIZE)
         try:
             msg = json.loads(data.decode())
             if msg.get("msgType") == "Report":
@@ -277,16 +387,97 @@ def listen_multicast(callback):
         except:
             pass
 
-# ---------------- Main Program ----------------
-if __name__ == "__main__":
+# ---------------- Command line ----------------
+# Subcommands print one JSON object per line (NDJSON) on stdout; all the
+# human-readable chatter of BrelHub goes to stderr so output can be piped.
+OUT = sys.stdout
+
+
+def emit(obj):
+    OUT.write(json.dumps(obj) + "\n")
+    OUT.flush()
+
+
+def int_or_dash(value):
+    """argparse type for set: an integer, or '-' to leave the value unchanged"""
+    if value == "-":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer or '-', got {value!r}")
+
+
+class CliParser(argparse.ArgumentParser):
+    """ArgumentParser that also reports usage errors as an NDJSON error line on stdout"""
+    def error(self, message):
+        emit({"error": message})
+        super().error(message)
+
+
+def connect(args):
+    host = args.host or scan_for_brel_hub(args.subnet, interface=args.interface)
+    if not host:
+        sys.exit(1)
+    hub = BrelHub(host, args.key)
+    if not hub.get_device_list():
+        print("No device list from Brel hub", file=sys.stderr)
+        sys.exit(1)
+    hub.generate_access_token()
+    return hub
+
+
+def cmd_scan(args):
+    for ip, rtt in sweep_for_brel_hubs(args.subnet, deadline=args.deadline, interface=args.interface):
+        emit({"host": ip, "rtt_ms": rtt})
+
+
+def cmd_list(args):
+    hub = connect(args)
+    for mac, dev in hub.devices.items():
+        emit(dict(dev, host=hub.host))
+
+
+def cmd_poll(args):
+    hub = connect(args)
+    results = hub.poll_all_devices()
+    if not args.json:
+        with contextlib.redirect_stdout(OUT):
+            hub.print_device_table(results)
+        return
+    for mac, data in results.items():
+        emit(data)
+
+
+def cmd_set(args):
+    hub = connect(args)
+    P = None if args.position == "-" else args.position
+    A = None if args.angle in (None, "-") else args.angle
+    ack = hub.set_value(args.mac, P, A)
+    emit(ack if ack else {"mac": args.mac, "error": "no reply"})
+    if not ack:
+        sys.exit(1)
+
+
+def cmd_watch(args):
+    def report(msg):
+        msg["ts"] = round(time.time(), 3)
+        emit(msg)
+    try:
+        listen_multicast(report)
+    except KeyboardInterrupt:
+        pass
+
+
+def interactive(args):
     print("=== Brel Hub Network Scanner & Monitor ===")
     
     # Scan local network and return first found hub
-    HOST = scan_for_brel_hub(SUBNET_IP + ".0/24")
+    HOST = args.host or scan_for_brel_hub(args.subnet, interface=args.interface)
     if not HOST:
         exit(0)
 
-    hub = BrelHub(HOST, KEY)
+    hub = BrelHub(HOST, args.key)
 
     # Start multicast listener in background
     threading.Thread(
@@ -347,3 +538,40 @@ if __name__ == "__main__":
             break
         else:
             print("Unknown command")
+
+
+def main(argv=None):
+    parser = CliParser(description="Brel Home Hub 03/2 monitor & controller. "
+                                     "Without a command the interactive menu starts.")
+    parser.add_argument("--host", default=os.environ.get("BREL_HOST"), help="hub IP, skips the scan ($BREL_HOST)")
+    parser.add_argument("--subnet", default=os.environ.get("BREL_SUBNET", SUBNET_IP + ".0/24"),
+                        help="CIDR to scan for hubs ($BREL_SUBNET)")
+    parser.add_argument("--interface", default=os.environ.get("BREL_INTERFACE"),
+                        help="local IP or interface name to scan from ($BREL_INTERFACE)")
+    parser.add_argument("--key", default=os.environ.get("BREL_KEY", KEY), help="16-byte hub KEY ($BREL_KEY)")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("scan", help="sweep the subnet, one hub per line")
+    p.add_argument("--deadline", type=float, default=3.0)
+    p.set_defaults(func=cmd_scan)
+    sub.add_parser("list", help="devices known to the hub, one per line").set_defaults(func=cmd_list)
+    p = sub.add_parser("poll", help="read all devices")
+    p.add_argument("--json", action="store_true", help="one ReadDevice reply per line instead of a table")
+    p.set_defaults(func=cmd_poll)
+    p = sub.add_parser("set", help="set position and/or angle, '-' leaves a value unchanged")
+    p.add_argument("mac")
+    p.add_argument("position", type=int_or_dash)
+    p.add_argument("angle", nargs="?", type=int_or_dash)
+    p.set_defaults(func=cmd_set)
+    sub.add_parser("watch", help="stream every multicast Report as one JSON line").set_defaults(func=cmd_watch)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        interactive(args)
+        return
+    with contextlib.redirect_stdout(sys.stderr):
+        args.func(args)
+
+
+# ---------------- Main Program ----------------
+if __name__ == "__main__":
+    main()
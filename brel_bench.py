@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# brel_bench.py - Offline protocol benchmarks against brel_sim.BrelHubSimulator
+# Measures poll-sweep time and command round-trip latency percentiles for
+# brel_lib.BrelHubSet or the standalone script, and Report ingestion rate
+# through brel_lib's handle_report and plugin.py's pipeline (via brel_harness).
+#
+#   python3 brel_bench.py --devices 40 --latency 0.02 --jitter 0.01 --loss 0.02
+import argparse
+import contextlib
+import io
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import brel_sim
+
+MULTICAST_PORT = 32101
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(samples)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def make_hub(impl, host, key):
+    if impl == "standalone":
+        import Brel_StandAlone_V005 as standalone
+        hub = standalone.BrelHub(host, key)
+    else:
+        import brel_lib
+        hub = brel_lib.BrelHubSet([host], key)
+    with contextlib.redirect_stdout(io.StringIO()):
+        hub.get_device_list()
+        hub.generate_access_token()
+    return hub
+
+
+def motor_macs(hub):
+    return [mac for mac in hub.devices if len(mac) >= 15]
+
+
+def bench_poll_sweep(hub, rounds=3):
+    """Seconds per full ReadDevice sweep through the implementation's own poll call"""
+    macs = motor_macs(hub)
+    times = []
+    for _ in range(rounds):
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if hasattr(hub, "poll_all_devices"):
+                results = hub.poll_all_devices()
+            else:
+                results = hub.poll_all(macs)
+        times.append(time.monotonic() - start)
+    ok = sum(1 for r in results.values() if r)
+    return {"devices": len(macs), "answered": ok, "best_s": round(min(times), 3), "avg_s": round(sum(times) / len(times), 3)}
+
+
+def bench_command_rtt(hub, count=200):
+    """WriteDevice round-trip latency percentiles in ms"""
+    macs = motor_macs(hub)
+    samples = []
+    failed = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(count):
+            start = time.monotonic()
+            ack = hub.set_value(macs[i % len(macs)], P=i % 101)
+            if ack and "actionResult" not in ack:
+                samples.append((time.monotonic() - start) * 1000)
+            else:
+                failed += 1
+    result = {k: round(v, 2) if v is not None else None for k, v in percentiles(samples).items()}
+    result.update(count=count, failed=failed)
+    return result
+
+
+def bench_report_ingest(sim, hub, count=20000):
+    """Reports per second received, decoded and applied by brel_lib's codec and handle_report"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.5)
+    received = [0, 0, None, None]  # datagrams, applied, first, last
+    decode = hub.hubs[sim.host].codec.decode
+
+    def consume():
+        buf = bytearray(65535)
+        while True:
+            try:
+                size, _ = sock.recvfrom_into(buf)
+            except (socket.timeout, OSError):
+                return
+            msg = decode(buf[:size])
+            if msg is not None and hub.handle_report(msg):
+                received[1] += 1
+            now = time.monotonic()
+            received[2] = received[2] or now
+            received[3] = now
+            received[0] += 1
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    previous, sim.report_target = sim.report_target, sock.getsockname()
+    try:
+        sim.burst_reports(count)
+        consumer.join()
+    finally:
+        sim.report_target = previous
+        sock.close()
+    got, applied, first, last = received
+    elapsed = (last - first) if first and last and last > first else None
+    return {"sent": count, "received": got, "applied": applied, "per_s": round(got / elapsed) if elapsed else None}
+
+
+def bench_plugin_ingest(sim, count=20000):
+    """Reports per second through plugin.py's listen_multicast/apply_reports under brel_harness"""
+    import brel_harness
+    home = tempfile.mkdtemp(prefix="brel_bench_")
+    runtime = brel_harness.FakeDomoticz({"Address": sim.host, "Password": sim.key.decode(), "HomeFolder": home + "/",
+                                         "Mode2": "0", "Mode3": "0", "Mode5": "0", "Mode6": ""}, max_unit=0)
+    harness = brel_harness.PluginHarness(runtime)
+    previous, sim.report_target = sim.report_target, ("127.0.0.1", MULTICAST_PORT)
+    try:
+        harness.start()
+        harness.wait_for_devices(len(sim.motors) * 5 + 2)
+        stats = harness.plugin.hub.stats
+        updates_before = sum(runtime.updates.values())
+        base = stats.reports
+        start = last_change = time.monotonic()
+        sim.burst_reports(count)
+        seen = stats.reports
+        # Done once the apply stage has been idle for half a second
+        while time.monotonic() - last_change < 0.5:
+            time.sleep(0.01)
+            if stats.reports != seen:
+                seen = stats.reports
+                last_change = time.monotonic()
+        counters = stats.snapshot()["counters"]
+        harness.stop()
+    finally:
+        sim.report_target = previous
+        shutil.rmtree(home, ignore_errors=True)
+    ingested = seen - base
+    elapsed = last_change - start
+    return {"sent": count, "ingested": ingested, "queue_dropped": counters.get("multicast_dropped", 0),
+            "device_updates": sum(runtime.updates.values()) - updates_before,
+            "per_s": round(ingested / elapsed) if elapsed > 0 else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brel protocol benchmarks against a simulated hub")
+    parser.add_argument("--impl", choices=("lib", "standalone"), default="lib")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--devices", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--reports", type=int, default=20000)
+    args = parser.parse_args()
+
+    with brel_sim.BrelHubSimulator(args.host, devices=args.devices, latency=args.latency,
+                                   jitter=args.jitter, loss=args.loss, report_interval=3600) as sim:
+        hub = make_hub(args.impl, args.host, brel_sim.KEY)
+        results = {
+            "poll_sweep": bench_poll_sweep(hub),
+            "command_rtt_ms": bench_command_rtt(hub, args.commands),
+            "report_ingest": bench_report_ingest(sim, hub, args.reports) if args.impl == "lib" else None,
+            "plugin_report_ingest": bench_plugin_ingest(sim, args.reports),
+            "simulator": dict(sim.stats),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# brel_capture.py - Wire-level capture of Brel hub traffic and a replay driver
+# CaptureWriter appends every datagram BrelHub sends or receives and every
+# multicast datagram, with its monotonic time, to a compact binary file.
+# replay() feeds a capture back at real or accelerated speed, so bursts seen
+# at a real site can be reproduced against brel_sim.py and profiled offline.
+#
+#   python3 brel_capture.py summary brel_capture-20260101-120000.bin
+#   python3 brel_capture.py replay brel_capture-20260101-120000.bin --speed 10 --hub 127.0.0.1
+import argparse
+import json
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b"BRCP"
+VERSION = 1
+HEADER = struct.Struct("<4sBxxxd")  # magic, version, wall-clock start
+RECORD = struct.Struct("<dB4sHI")  # seconds since start, kind, IPv4, port, payload length
+TX, RX, MULTICAST = 0, 1, 2
+KINDS = ("tx", "rx", "multicast")
+UNICAST_PORT = 32100
+MULTICAST_PORT = 32101
+
+
+class CaptureWriter:
+    """Thread-safe append-only capture file; stops writing once max_bytes is reached.
+
+    A write error (disk full, failing SD card) closes the file and is
+    reported once through on_error; callers never see capture errors.
+    """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, on_error=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.on_error = on_error
+        self.error = None
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.size = HEADER.size
+        self.records = 0
+        self.skipped = 0
+
+    def write(self, kind, addr, data):
+        ts = time.monotonic() - self.start
+        try:
+            ip = socket.inet_aton(addr[0])
+        except OSError:
+            ip = bytes(4)
+        with self.lock:
+            if self.file is None or self.size + RECORD.size + len(data) > self.max_bytes:
+                self.skipped += 1
+                return
+            try:
+                self.file.write(RECORD.pack(ts, kind, ip, addr[1], len(data)))
+                self.file.write(data)
+            except OSError as e:
+                self._fail(e)
+                return
+            self.size += RECORD.size + len(data)
+            self.records += 1
+
+    def flush(self):
+        with self.lock:
+            if self.file:
+                try:
+                    self.file.flush()
+                except OSError as e:
+                    self._fail(e)
+
+    def _fail(self, error):
+        """Stop capturing after an I/O error; called with self.lock held"""
+        self.skipped += 1
+        self.error = error
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+        if self.on_error:
+            try:
+                self.on_error(error)
+            except Exception:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+                self.file = None
+
+
+def read_capture(path):
+    """Yield (seconds since start, kind, (host, port), data); a truncated tail is ignored"""
+    with open(path, "rb") as f:
+        magic, version, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a Brel capture file")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            ts, kind, ip, port, length = RECORD.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield ts, kind, (socket.inet_ntoa(ip), port), data
+
+
+def replay(path, handlers, speed=1.0, stop_event=None):
+    """Call handlers[kind](addr, data) for every record in capture order.
+
+    speed scales the captured timing (10 = ten times faster, 0 = flat out).
+    Returns the number of records handled per kind name.
+    """
+    counts = dict.fromkeys(KINDS, 0)
+    start = time.monotonic()
+    for ts, kind, addr, data in read_capture(path):
+        if stop_event is not None and stop_event.is_set():
+            break
+        handler = handlers.get(kind)
+        if handler is None:
+            continue
+        if speed:
+            ahead = start + ts / speed - time.monotonic()
+            if ahead > 0:
+                time.sleep(ahead)
+        handler(addr, data)
+        counts[KINDS[kind]] += 1
+    return counts
+
+
+def summary(path):
+    """Record counts per kind and msgType, duration and the busiest second"""
+    kinds = dict.fromkeys(KINDS, 0)
+    msg_types = {}
+    per_second = {}
+    last = 0.0
+    for ts, kind, _, data in read_capture(path):
+        kinds[KINDS[kind]] += 1
+        try:
+            msg_type = json.loads(data.decode("utf-8", errors="ignore")).get("msgType", "?")
+        except (ValueError, AttributeError):
+            msg_type = "undecodable"
+        key = f"{KINDS[kind]}:{msg_type}"
+        msg_types[key] = msg_types.get(key, 0) + 1
+        per_second[int(ts)] = per_second.get(int(ts), 0) + 1
+        last = ts
+    return {"records": sum(kinds.values()), "duration_s": round(last, 3), "kinds": kinds,
+            "msg_types": dict(sorted(msg_types.items())), "peak_per_s": max(per_second.values(), default=0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay a Brel capture file")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("summary", help="print record counts and rates")
+    p.add_argument("path")
+    p = sub.add_parser("replay", help="resend captured requests and multicast datagrams")
+    p.add_argument("path")
+    p.add_argument("--speed", type=float, default=1.0, help="timing multiplier, 0 = as fast as possible")
+    p.add_argument("--hub", help="send captured requests (tx) to this hub or simulator IP")
+    p.add_argument("--reports", default=f"127.0.0.1:{MULTICAST_PORT}",
+                   help="send captured multicast datagrams to host:port (empty to skip)")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        print(json.dumps(summary(args.path), indent=2))
+        return
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    handlers = {}
+    if args.hub:
+        handlers[TX] = lambda addr, data: sock.sendto(data, (args.hub, UNICAST_PORT))
+    if args.reports:
+        host, _, port = args.reports.rpartition(":")
+        target = (host, int(port))
+        handlers[MULTICAST] = lambda addr, data: sock.sendto(data, target)
+    start = time.monotonic()
+    counts = replay(args.path, handlers, args.speed)
+    sock.close()
+    print(json.dumps({"replayed": counts, "elapsed_s": round(time.monotonic() - start, 3)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# brel_crypto.py - AccessToken derivation for the Brel Home Hub
+# The AccessToken is the hub's 16-byte gateway token encrypted with the KEY
+# using AES-128-ECB without padding, as hex in upper case. pycryptodome is
+# imported on first use only; when it is missing, a small pure-Python
+# AES-128 encryptor is used instead (a token is one block, so speed is moot).
+import binascii
+import functools
+
+_encrypt = None
+BACKEND = None  # "pycryptodome" or "builtin" once the first token was derived
+
+
+def _xtime(a):
+    a <<= 1
+    return (a ^ 0x11B) if a & 0x100 else a
+
+
+def _build_sbox():
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # p walks all non-zero elements of GF(2^8) as powers of 3, q = p^-1
+        p = p ^ _xtime(p)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        x = q
+        for shift in range(1, 5):
+            x ^= ((q << shift) | (q >> (8 - shift))) & 0xFF
+        sbox[p] = x ^ 0x63
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    return sbox
+
+
+SBOX = _build_sbox()
+
+
+def _expand_key(key):
+    words = [list(key[i:i + 4]) for i in range(0, 16, 4)]
+    rcon = 1
+    for i in range(4, 44):
+        word = list(words[i - 1])
+        if i % 4 == 0:
+            word = [SBOX[b] for b in word[1:] + word[:1]]
+            word[0] ^= rcon
+            rcon = _xtime(rcon)
+        words.append([a ^ b for a, b in zip(words[i - 4], word)])
+    return [sum(words[r * 4:r * 4 + 4], []) for r in range(11)]
+
+
+def _encrypt_block(round_keys, block):
+    s = [a ^ b for a, b in zip(block, round_keys[0])]
+    for rnd in range(1, 11):
+        s = [SBOX[b] for b in s]
+        # ShiftRows: the state is column-major, byte r + 4c is row r, column c
+        s = [s[r + 4 * ((c + r) % 4)] for c in range(4) for r in range(4)]
+        if rnd < 10:
+            mixed = []
+            for c in range(0, 16, 4):
+                a0, a1, a2, a3 = s[c:c + 4]
+                t = a0 ^ a1 ^ a2 ^ a3
+                mixed += [a0 ^ t ^ _xtime(a0 ^ a1), a1 ^ t ^ _xtime(a1 ^ a2),
+                          a2 ^ t ^ _xtime(a2 ^ a3), a3 ^ t ^ _xtime(a3 ^ a0)]
+            s = mixed
+        s = [a ^ b for a, b in zip(s, round_keys[rnd])]
+    return bytes(s)
+
+
+def aes128_ecb_encrypt(key, data):
+    """AES-128-ECB encryption of data (a multiple of 16 bytes) without padding"""
+    if len(key) != 16:
+        raise ValueError("AES key must be exactly 16 bytes")
+    if len(data) % 16:
+        raise ValueError("Data must be a multiple of 16 bytes in ECB mode")
+    round_keys = _expand_key(key)
+    return b"".join(_encrypt_block(round_keys, data[i:i + 16]) for i in range(0, len(data), 16))
+
+
+def _load_backend():
+    global _encrypt, BACKEND
+    try:
+        from Crypto.Cipher import AES
+
+        def _encrypt(key, data):
+            return AES.new(key, AES.MODE_ECB).encrypt(data)
+        BACKEND = "pycryptodome"
+    except ImportError:
+        _encrypt = aes128_ecb_encrypt
+        BACKEND = "builtin"
+    return _encrypt
+
+
+@functools.lru_cache(maxsize=32)
+def derive_access_token(key, token):
+    """AccessToken for gateway token, recomputed only when the hub rotates its token"""
+    if isinstance(key, str):
+        key = key.encode()
+    if len(key) != 16:
+        raise ValueError("AES key must be exactly 16 bytes")
+    encrypt = _encrypt or _load_backend()
+    return binascii.hexlify(encrypt(key, token.encode())).decode().upper()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# brel_harness.py - Run plugin.py outside Domoticz and profile it at scale
+# FakeDomoticz stands in for the Domoticz module and the Devices/Parameters
+# globals. PluginHarness drives onStart/onHeartbeat/onCommand/onStop the way
+# Domoticz does and records CPU time per callback and Update calls per unit,
+# while brel_sim.py provides as many hubs and motors as needed.
+#
+#   python3 brel_harness.py --hubs 4 --devices 60 --duration 30 --commands 5 --max-unit 0
+import argparse
+import cProfile
+import importlib
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter, deque
+
+import brel_sim
+
+DOMOTICZ_MAX_UNIT = 255  # legacy Python plugins are limited to units 1-255
+
+
+class FakeDevice:
+    """Domoticz.Device stand-in with the attributes and calls plugin.py uses"""
+    def __init__(self, runtime, Name, Unit, Type=244, Subtype=73, Switchtype=0, DeviceID="", Options=None,
+                 Image=0, Used=0):
+        self.runtime = runtime
+        self.Name = Name
+        self.Unit = Unit
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.DeviceID = DeviceID
+        self.Options = dict(Options or {})
+        self.Image = Image
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.LastUpdate = None
+
+    def Create(self):
+        self.runtime.create(self)
+
+    def Update(self, nValue, sValue, Options=None, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        if Options is not None:
+            self.Options = dict(Options)
+        self.LastUpdate = time.time()
+        self.runtime.updated(self)
+
+    def Delete(self):
+        self.runtime.Devices.pop(self.Unit, None)
+
+
+class FakeDomoticz:
+    """In-process Domoticz API: the Domoticz module, Devices, Parameters and call counters.
+
+    max_unit mirrors the 1-255 unit limit of legacy plugins; 0 lifts it so the
+    plugin's own scaling can be measured beyond what Domoticz would allow.
+    """
+    def __init__(self, parameters, max_unit=DOMOTICZ_MAX_UNIT, echo=False, log_size=1000):
+        self.Devices = {}
+        self.Parameters = dict(parameters)
+        self.max_unit = max_unit
+        self.echo = echo
+        self.log = deque(maxlen=log_size)
+        self.log_counts = Counter()
+        self.updates = Counter()  # unit -> Update calls
+        self.update_threads = Counter()  # thread name -> Update calls
+        self.creates = 0
+        self.refused = 0
+        self.heartbeat_interval = 10
+        self.lock = threading.Lock()
+        self.module = types.ModuleType("Domoticz")
+        self.module.Device = lambda **kwargs: FakeDevice(self, **kwargs)
+        self.module.Log = lambda message: self._log("Log", message)
+        self.module.Status = lambda message: self._log("Status", message)
+        self.module.Error = lambda message: self._log("Error", message)
+        self.module.Debug = lambda message: self._log("Debug", message)
+        self.module.Debugging = lambda level: None
+        self.module.Heartbeat = self._set_heartbeat
+
+    def install(self):
+        sys.modules["Domoticz"] = self.module
+
+    def _log(self, level, message):
+        with self.lock:
+            self.log_counts[level] += 1
+            self.log.append((time.time(), level, message))
+        if self.echo:
+            print(f"{level.upper():6} {message}", file=sys.stderr)
+
+    def _set_heartbeat(self, seconds):
+        self.heartbeat_interval = seconds
+
+    def create(self, device):
+        with self.lock:
+            if self.max_unit and not 1 <= device.Unit <= self.max_unit:
+                self.refused += 1
+                refused = True
+            else:
+                self.Devices[device.Unit] = device
+                self.creates += 1
+                refused = False
+        if refused:
+            self._log("Error", f"Device creation failed, Unit {device.Unit} outside 1-{self.max_unit}: {device.Name}")
+
+    def updated(self, device):
+        with self.lock:
+            self.updates[device.Unit] += 1
+            self.update_threads[threading.current_thread().name] += 1
+
+
+class PluginHarness:
+    """Loads plugin.py against a FakeDomoticz and times every callback on the calling thread"""
+    def __init__(self, runtime, module="plugin", profile=False):
+        self.runtime = runtime
+        runtime.install()
+        self.module = importlib.import_module(module)
+        self.module.Devices = runtime.Devices
+        self.module.Parameters = runtime.Parameters
+        self.plugin = self.module.BasePlugin()
+        self.timings = {}  # callback -> [(cpu s, wall s)]
+        self.profiler = cProfile.Profile() if profile else None
+        self.cpu_start = time.process_time()
+        self.peak_threads = threading.active_count()
+
+    def call(self, name, *args):
+        cpu, wall = time.thread_time(), time.perf_counter()
+        if self.profiler:
+            self.profiler.enable()
+        try:
+            return getattr(self.plugin, name)(*args)
+        finally:
+            if self.profiler:
+                self.profiler.disable()
+            self.timings.setdefault(name, []).append((time.thread_time() - cpu, time.perf_counter() - wall))
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def start(self):
+        self.call("onStart")
+
+    def heartbeat(self):
+        self.call("onHeartbeat")
+
+    def command(self, unit, command, level=0, hue=""):
+        self.call("onCommand", unit, command, level, hue)
+
+    def stop(self):
+        self.call("onStop")
+
+    def wait_for_devices(self, count, timeout=30, heartbeat=1.0):
+        """Wait until count devices were created or refused, calling onHeartbeat every heartbeat seconds"""
+        end = time.monotonic() + timeout
+        next_beat = time.monotonic() + heartbeat
+        while time.monotonic() < end and len(self.runtime.Devices) + self.runtime.refused < count:
+            if time.monotonic() >= next_beat:
+                self.heartbeat()
+                next_beat += heartbeat
+            time.sleep(0.05)
+        return len(self.runtime.Devices)
+
+    def report(self):
+        callbacks = {}
+        for name, samples in self.timings.items():
+            cpu = [c for c, _ in samples]
+            wall = [w for _, w in samples]
+            callbacks[name] = {
+                "calls": len(samples),
+                "cpu_ms_total": round(sum(cpu) * 1000, 2),
+                "cpu_ms_avg": round(sum(cpu) * 1000 / len(cpu), 3),
+                "cpu_ms_max": round(max(cpu) * 1000, 3),
+                "wall_ms_max": round(max(wall) * 1000, 3),
+            }
+        updates = self.runtime.updates
+        return {
+            "devices": len(self.runtime.Devices),
+            "creates_refused": self.runtime.refused,
+            "callbacks": callbacks,
+            "process_cpu_s": round(time.process_time() - self.cpu_start, 3),
+            "updates_total": sum(updates.values()),
+            "updates_busiest_units": dict(updates.most_common(5)),
+            "updates_by_thread": dict(self.runtime.update_threads),
+            "log_counts": dict(self.runtime.log_counts),
+            "peak_threads": self.peak_threads,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile plugin.py under a fake Domoticz against simulated hubs")
+    parser.add_argument("--hubs", type=int, default=1, help="simulated hubs on 127.0.0.1, 127.0.0.2, ...")
+    parser.add_argument("--devices", type=int, default=40, help="motors per hub")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run after setup")
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="seconds between onHeartbeat calls")
+    parser.add_argument("--commands", type=float, default=2.0, help="Set Level commands per second")
+    parser.add_argument("--report-interval", type=float, default=0.5, help="simulator Report period while moving")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--max-unit", type=int, default=DOMOTICZ_MAX_UNIT, help="0 = no unit limit")
+    parser.add_argument("--mode", action="append", default=[], metavar="ModeN=value",
+                        help="plugin parameter, e.g. Mode3=200 or Mode6=position=60")
+    parser.add_argument("--cprofile", metavar="FILE", help="write cProfile stats of the callbacks to FILE")
+    parser.add_argument("--echo", action="store_true", help="print plugin log lines to stderr")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="brel_harness_")
+    hosts = [f"127.0.0.{i + 1}" for i in range(args.hubs)]
+    parameters = {"Address": ",".join(hosts), "Password": brel_sim.KEY, "HomeFolder": home + "/",
+                  "Mode1": "", "Mode2": "0", "Mode3": "0", "Mode4": "1", "Mode5": "0", "Mode6": ""}
+    for item in args.mode:
+        key, _, value = item.partition("=")
+        parameters[key] = value
+
+    sims = [brel_sim.BrelHubSimulator(host, devices=args.devices, latency=args.latency,
+                                      report_target=("127.0.0.1", brel_sim.MULTICAST_PORT),
+                                      report_interval=args.report_interval, seed=args.seed + i).start()
+            for i, host in enumerate(hosts)]
+    runtime = FakeDomoticz(parameters, max_unit=args.max_unit, echo=args.echo)
+    harness = PluginHarness(runtime, profile=bool(args.cprofile))
+    rng = random.Random(args.seed)
+    try:
+        setup_start = time.monotonic()
+        harness.start()
+        # Every motor gets five units, every hub one, plus the scene selector
+        expected = args.hubs * (args.devices * 5 + 1) + 1
+        harness.wait_for_devices(expected, heartbeat=args.heartbeat)
+        setup_s = time.monotonic() - setup_start
+
+        position_units = [u for u, d in runtime.Devices.items() if d.DeviceID.endswith(":currentPosition")]
+        end = time.monotonic() + args.duration
+        next_beat = next_command = time.monotonic()
+        while time.monotonic() < end:
+            now = time.monotonic()
+            if now >= next_beat:
+                harness.heartbeat()
+                next_beat += args.heartbeat
+            if args.commands and position_units and now >= next_command:
+                harness.command(rng.choice(position_units), "Set Level", rng.randint(0, 100))
+                next_command += 1.0 / args.commands
+            time.sleep(max(0.0, min(next_beat, next_command if args.commands else end, end) - time.monotonic()))
+        harness.stop()
+    finally:
+        for sim in sims:
+            sim.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+    result = harness.report()
+    result["setup_s"] = round(setup_s, 3)
+    result["simulators"] = [dict(sim.stats) for sim in sims]
+    if args.cprofile:
+        harness.profiler.dump_stats(args.cprofile)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# brel_history.py - Compact on-disk time series of Brel motor telemetry
+# One memory-mapped ring file per MAC with fixed 12-byte records, so every
+# Report can be kept without touching the Domoticz database. The oldest
+# records are overwritten once a file is full, which bounds disk usage.
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"BRTS"
+VERSION = 1
+HEADER = struct.Struct("<4sBxxxIII")  # magic, version, capacity, head, count
+RECORD = struct.Struct("<IhhHBb")  # epoch s, position, angle, battery, charging, RSSI
+FIELDS = ("currentPosition", "currentAngle", "batteryLevel", "chargingState", "RSSI")
+# Stored in place of a missing value
+MISSING = (-32768, -32768, 0xFFFF, 0xFF, -128)
+LIMITS = ((-32767, 32767), (-32767, 32767), (0, 0xFFFE), (0, 0xFE), (-127, 127))
+
+
+def _pack_value(value, index):
+    if value is None:
+        return MISSING[index]
+    low, high = LIMITS[index]
+    return max(low, min(high, int(value)))
+
+
+class RingRecorder:
+    """Fixed-capacity ring of telemetry records in one memory-mapped file"""
+    def __init__(self, path, capacity=16384):
+        self.path = path
+        self.lock = threading.Lock()
+        size = HEADER.size + capacity * RECORD.size
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        self.file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            magic, version, stored_capacity, head, count = HEADER.unpack(self.file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a Brel history file")
+            capacity = stored_capacity
+            size = HEADER.size + capacity * RECORD.size
+        else:
+            head = count = 0
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.capacity = capacity
+        self.head = head
+        self.count = count
+        self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.capacity, self.head, self.count)
+
+    def append(self, ts, values):
+        """values: (position, angle, battery, charging, RSSI); None where unknown"""
+        packed = [_pack_value(v, i) for i, v in enumerate(values)]
+        with self.lock:
+            RECORD.pack_into(self.map, HEADER.size + self.head * RECORD.size, int(ts), *packed)
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self._write_header()
+
+    def records(self, start=None, end=None):
+        """Yield (ts, position, angle, battery, charging, RSSI) oldest first, None for missing values"""
+        with self.lock:
+            first = (self.head - self.count) % self.capacity
+            base = HEADER.size
+            if first + self.count <= self.capacity:
+                data = self.map[base + first * RECORD.size:base + (first + self.count) * RECORD.size]
+            else:
+                data = (self.map[base + first * RECORD.size:base + self.capacity * RECORD.size]
+                        + self.map[base:base + self.head * RECORD.size])
+        for record in RECORD.iter_unpack(data):
+            ts = record[0]
+            if (start is not None and ts < start) or (end is not None and ts >= end):
+                continue
+            yield (ts,) + tuple(None if v == MISSING[i] else v for i, v in enumerate(record[1:]))
+
+    def flush(self):
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+
+class TelemetryHistory:
+    """Per-MAC ring files under directory, with range queries and bucketed aggregates"""
+    def __init__(self, directory, capacity=16384):
+        self.directory = directory
+        self.capacity = capacity
+        self.recorders = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _recorder(self, mac):
+        recorder = self.recorders.get(mac)
+        if recorder is None:
+            with self.lock:
+                recorder = self.recorders.get(mac)
+                if recorder is None:
+                    path = os.path.join(self.directory, f"{mac}.brts")
+                    recorder = self.recorders[mac] = RingRecorder(path, self.capacity)
+        return recorder
+
+    def macs(self):
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".brts"))
+
+    def record(self, mac, data, ts=None):
+        """Store the telemetry fields of one Report or ReadDevice reply"""
+        values = tuple(data.get(field) for field in FIELDS)
+        if all(v is None for v in values):
+            return
+        self._recorder(mac).append(time.time() if ts is None else ts, values)
+
+    def _records(self, mac, start, end):
+        if mac not in self.recorders and not os.path.exists(os.path.join(self.directory, f"{mac}.brts")):
+            return iter(())
+        return self._recorder(mac).records(start, end)
+
+    def query(self, mac, start=None, end=None):
+        """Records of mac with start <= ts < end as dicts keyed by the Report field names"""
+        return [dict(zip(("ts",) + FIELDS, record)) for record in self._records(mac, start, end)]
+
+    def aggregate(self, mac, field, bucket, start=None, end=None):
+        """[(bucket start, min, max, avg, count)] of one field per bucket seconds"""
+        index = FIELDS.index(field) + 1
+        buckets = {}
+        for record in self._records(mac, start, end):
+            value = record[index]
+            if value is None:
+                continue
+            key = record[0] - record[0] % bucket
+            entry = buckets.get(key)
+            if entry is None:
+                buckets[key] = [value, value, value, 1]
+            else:
+                entry[0] = min(entry[0], value)
+                entry[1] = max(entry[1], value)
+                entry[2] += value
+                entry[3] += 1
+        return [(key, low, high, round(total / count, 2), count)
+                for key, (low, high, total, count) in sorted(buckets.items())]
+
+    def flush(self):
+        for recorder in list(self.recorders.values()):
+            recorder.flush()
+
+    def close(self):
+        with self.lock:
+            for recorder in self.recorders.values():
+                recorder.close()
+            self.recorders.clear()
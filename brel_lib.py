@@ -2,51 +2,167 @@
 # Handles UDP requests and AES token generation
 import socket
 import json
-import binascii
-from datetime import datetime
-from Crypto.Cipher import AES
 import re
+import time
+import threading
+from brel_crypto import derive_access_token
+from brel_transport import RttEstimator, RETRIES
+from brel_state import DeviceState
+
+# Optional faster JSON backend; both paths take and return bytes
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+    _loads = json.loads
 
 MULTICAST_IP = "238.0.0.18"
 UNICAST_PORT = 32100
 MULTICAST_PORT = 32101
+RECV_BUFSIZE = 65535  # GetDeviceList replies of large installations exceed 4 kB
+
+class MsgIdClock:
+    """Strictly increasing epoch milliseconds derived from the monotonic clock"""
+    def __init__(self):
+        self._offset = time.time() * 1000 - time.monotonic() * 1000
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        ms = int(self._offset + time.monotonic() * 1000)
+        with self._lock:
+            if ms <= self._last:
+                ms = self._last + 1
+            self._last = ms
+        return ms
+
+
+class BrelCodec:
+    """Request encoder with pre-built per-MAC JSON prefixes, and reply decoder
+
+    Only the msgID digits, AccessToken and data change between requests to
+    the same device, so everything else is encoded once in register().
+    """
+    def __init__(self):
+        self.clock = MsgIdClock()
+        self._templates = {}  # mac -> (msgID base, ReadDevice prefix, WriteDevice prefix)
+        self._list_prefix = b'{"msgType":"GetDeviceList","msgID":"101'
+
+    @staticmethod
+    def msg_id_base(mac):
+        nums = re.findall(r'\d+', mac) if mac else None
+        return nums[-1] if nums else '101'
+
+    def register(self, mac, device_type):
+        base = self.msg_id_base(mac)
+        fields = f'"mac":{json.dumps(mac)},"deviceType":{json.dumps(device_type)},"msgID":"{base}'
+        self._templates[mac] = (
+            base,
+            ('{"msgType":"ReadDevice",' + fields).encode(),
+            ('{"msgType":"WriteDevice",' + fields).encode(),
+        )
+
+    def get_device_list(self):
+        ms = self.clock.next()
+        return f"101{ms}", self._list_prefix + str(ms).encode() + b'"}'
+
+    def read_device(self, mac):
+        base, prefix, _ = self._templates[mac]
+        ms = str(self.clock.next())
+        return base + ms, prefix + ms.encode() + b'"}'
+
+    def write_device(self, mac, access_token, data):
+        base, _, prefix = self._templates[mac]
+        ms = str(self.clock.next())
+        return base + ms, (prefix + ms.encode() + b'","AccessToken":' + _dumps(access_token)
+                           + b',"data":' + _dumps(data) + b'}')
+
+    @staticmethod
+    def encode(payload):
+        return _dumps(payload)
+
+    @staticmethod
+    def decode(data):
+        try:
+            return _loads(data)
+        except ValueError:
+            return None
+
 
 class BrelHub:
-    def __init__(self, host, key, secret=None):
+    def __init__(self, host, key, secret=None, retries=None):
         self.host = host
         self.key = key.encode() if isinstance(key, str) else key
         self.secret = secret
         self.devices = {}
         self.gateway = None
         self.access_token = None
+        self.rtt = RttEstimator()
+        self.retries = dict(RETRIES, **(retries or {}))
+        self.on_attempt = None  # callback(payload, attempt, outcome, rtt)
+        self.codec = BrelCodec()
+        self._local = threading.local()  # per-thread reusable receive buffer
+        self.state = {}  # mac -> DeviceState
 
     def _timestamp(self, mac=None):
-        base = '101'
-        if mac:
-            nums = re.findall(r'\d+', mac)
-            if nums: base = nums[-1]
-        ms = int((datetime.utcnow() - datetime(1970,1,1)).total_seconds() * 1000)
-        return f"{base}{ms}"
-
-    def _send_request(self, payload, timeout=3):
+        return f"{self.codec.msg_id_base(mac)}{self.codec.clock.next()}"
+
+    def _buffer(self):
+        buf = getattr(self._local, "buffer", None)
+        if buf is None:
+            buf = self._local.buffer = bytearray(RECV_BUFSIZE)
+        return buf
+
+    def _send_request(self, payload, timeout=3, retries=None):
+        return self._send_raw(self.codec.encode(payload), payload["msgType"], payload.get("mac"),
+                              timeout=timeout, retries=retries)
+
+    def _send_raw(self, raw, msg_type, mac=None, timeout=3, retries=None):
+        if retries is None:
+            retries = self.retries.get(msg_type, 0)
+        buf = self._buffer()
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(timeout)
+        deadline = time.monotonic() + timeout
         try:
-            sock.sendto(bytes(json.dumps(payload), 'utf8'), (self.host, UNICAST_PORT))
-            reply, _ = sock.recvfrom(4096)
-            return json.loads(reply.decode())
+            for attempt in range(retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining if attempt == retries else min(self.rtt.timeout(attempt), remaining))
+                sent = time.monotonic()
+                sock.sendto(raw, (self.host, UNICAST_PORT))
+                try:
+                    size, _ = sock.recvfrom_into(buf)
+                except socket.timeout:
+                    self._record_attempt(msg_type, mac, attempt, "timeout", None)
+                    continue
+                rtt = time.monotonic() - sent
+                if attempt == 0:
+                    self.rtt.sample(rtt)
+                self._record_attempt(msg_type, mac, attempt, "ok", rtt)
+                return self.codec.decode(buf[:size])
+            return None
         except:
             return None
         finally:
             sock.close()
 
+    def _record_attempt(self, msg_type, mac, attempt, outcome, rtt):
+        if self.on_attempt:
+            self.on_attempt({"msgType": msg_type, "mac": mac}, attempt, outcome, rtt)
+
     def get_device_list(self):
-        msg = {"msgType": "GetDeviceList", "msgID": self._timestamp()}
-        data = self._send_request(msg)
+        _, raw = self.codec.get_device_list()
+        data = self._send_raw(raw, "GetDeviceList")
         if not data:
             return None
         self.gateway = data
         self.devices = {d['mac']: d for d in data.get('data', [])}
+        for mac, dev in self.devices.items():
+            self.codec.register(mac, dev["deviceType"])
         return self.devices
 
     def generate_access_token(self):
@@ -55,44 +171,177 @@ class BrelHub:
             return self.access_token
 
         try:
-            token = self.gateway["token"]
-            token_bytes = token.encode()
-
-            key = self.key
-            if len(key) != 16:
-                raise ValueError("AES key must be exactly 16 bytes")
-
-            cipher = AES.new(key, AES.MODE_ECB)
-
-            # EXACT match to standalone (NO padding!)
-            encrypted = cipher.encrypt(token_bytes)
-
-            self.access_token = binascii.hexlify(encrypted).decode().upper()
+            # EXACT match to standalone (NO padding!), cached per gateway token
+            self.access_token = derive_access_token(self.key, self.gateway["token"])
             return self.access_token
 
         except Exception as e:
             return None
 
 
-    def get_status(self, mac):
-        msg = {
-            "msgType": "ReadDevice",
-            "mac": mac,
-            "deviceType": self.devices[mac]["deviceType"],
-            "msgID": self._timestamp(mac)
-        }
-        return self._send_request(msg)
+    def update_state(self, mac, data, at=None):
+        state = self.state.get(mac)
+        if state is None:
+            state = self.state.setdefault(mac, DeviceState(mac, self.devices.get(mac, {}).get("deviceType")))
+        return state.update(data, at)
+
+    def handle_report(self, msg):
+        """Feed a decoded multicast Report into the state cache"""
+        if msg.get("msgType") != "Report" or not isinstance(msg.get("data"), dict):
+            return False
+        return self.update_state(msg.get("mac"), msg["data"])
+
+    def get_status(self, mac, max_age=None, force=False):
+        """ReadDevice reply; served from the state cache when it is at most max_age seconds old"""
+        state = self.state.get(mac)
+        if not force and max_age is not None and state is not None and state.age() <= max_age:
+            return state.as_reply()
+        _, raw = self.codec.read_device(mac)
+        sent = time.monotonic()
+        reply = self._send_raw(raw, "ReadDevice", mac)
+        if reply and isinstance(reply.get("data"), dict):
+            self.update_state(mac, reply["data"], at=sent)
+        return reply
 
     def set_value(self, mac, P=None, A=None):
         payload = {}
         if P is not None: payload['targetPosition'] = int(P)
         if A is not None: payload['targetAngle'] = int(A)
-        msg = {
-            "msgType": "WriteDevice",
-            "mac": mac,
-            "deviceType": self.devices[mac]["deviceType"],
-            "AccessToken": self.access_token,
-            "data": payload,
-            "msgID": self._timestamp(mac)
-        }
-        return self._send_request(msg)
+        _, raw = self.codec.write_device(mac, self.access_token, payload)
+        return self._send_raw(raw, "WriteDevice", mac)
+
+    def set_many(self, targets, timeout=3, retries=None):
+        """WriteDevice {mac: (P, A)} back-to-back from one socket, then collect the acks;
+        each round resends only the stragglers. Returns {"ok": {mac: ack}, "failed": [mac]}"""
+        if retries is None:
+            retries = self.retries.get("WriteDevice", 0)
+        raws = {}
+        ids = {}
+        for mac, (P, A) in targets.items():
+            payload = {}
+            if P is not None: payload['targetPosition'] = int(P)
+            if A is not None: payload['targetAngle'] = int(A)
+            ids[mac], raws[mac] = self.codec.write_device(mac, self.access_token, payload)
+        by_id = {msg_id: mac for mac, msg_id in ids.items()}
+        acks = {}
+        outstanding = list(raws)
+        buf = self._buffer()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        deadline = time.monotonic() + timeout
+        try:
+            for attempt in range(retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not outstanding:
+                    break
+                end = time.monotonic() + (remaining if attempt == retries else min(self.rtt.timeout(attempt), remaining))
+                for mac in outstanding:
+                    sock.sendto(raws[mac], (self.host, UNICAST_PORT))
+                while any(mac not in acks for mac in outstanding) and time.monotonic() < end:
+                    sock.settimeout(max(0.001, end - time.monotonic()))
+                    try:
+                        size, _ = sock.recvfrom_into(buf)
+                    except socket.timeout:
+                        break
+                    reply = self.codec.decode(buf[:size])
+                    if not isinstance(reply, dict):
+                        continue
+                    mac = by_id.get(str(reply.get("msgID"))) or reply.get("mac")
+                    if mac in raws and mac not in acks:
+                        acks[mac] = reply
+                for mac in outstanding:
+                    self._record_attempt("WriteDevice", mac, attempt, "ok" if mac in acks else "timeout", None)
+                outstanding = [mac for mac in outstanding if mac not in acks]
+        except OSError:
+            pass
+        finally:
+            sock.close()
+        return {"ok": acks, "failed": outstanding}
+
+
+def discover_hubs(timeout=3):
+    """Broadcast a GetDeviceList probe and return the IPs of all hubs answering within timeout"""
+    found = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    try:
+        _, probe = BrelCodec().get_device_list()
+        sock.sendto(probe, ("255.255.255.255", UNICAST_PORT))
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            sock.settimeout(max(0.01, end - time.monotonic()))
+            try:
+                _, addr = sock.recvfrom(RECV_BUFSIZE)
+            except socket.timeout:
+                break
+            if addr[0] not in found:
+                found.append(addr[0])
+    except OSError:
+        pass
+    finally:
+        sock.close()
+    return found
+
+
+class BrelHubSet:
+    """Several hubs sharing one key; requests are routed to the hub owning the MAC"""
+    def __init__(self, hosts, key, secret=None):
+        self.hubs = {host: BrelHub(host, key, secret) for host in hosts}
+        self.routes = {}
+        self.devices = {}
+
+    def _parallel(self, fn, hubs):
+        results = {}
+        def run(hub):
+            try:
+                results[hub.host] = fn(hub)
+            except Exception:
+                results[hub.host] = None
+        threads = [threading.Thread(target=run, args=(hub,)) for hub in hubs]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        return results
+
+    def get_device_list(self):
+        results = self._parallel(lambda hub: hub.get_device_list(), self.hubs.values())
+        self.routes = {mac: hub for hub in self.hubs.values() for mac in hub.devices}
+        self.devices = {mac: hub.devices[mac] for mac, hub in self.routes.items()}
+        return self.devices if any(results.values()) else None
+
+    def generate_access_token(self):
+        return {host: hub.generate_access_token() for host, hub in self.hubs.items() if hub.gateway}
+
+    def get_status(self, mac, max_age=None, force=False):
+        return self.routes[mac].get_status(mac, max_age, force)
+
+    def handle_report(self, msg):
+        hub = self.routes.get(msg.get("mac"))
+        return hub.handle_report(msg) if hub else False
+
+    def set_value(self, mac, P=None, A=None):
+        return self.routes[mac].set_value(mac, P, A)
+
+    def set_many(self, targets):
+        """Fan out {mac: (P, A)} to the owning hubs in parallel"""
+        groups = {}
+        for mac, target in targets.items():
+            if mac in self.routes:
+                groups.setdefault(self.routes[mac].host, {})[mac] = target
+        results = self._parallel(lambda hub: hub.set_many(groups[hub.host]), [self.hubs[host] for host in groups])
+        merged = {"ok": {}, "failed": [mac for mac in targets if mac not in self.routes]}
+        for host, result in results.items():
+            if result is None:
+                merged["failed"].extend(groups[host])
+            else:
+                merged["ok"].update(result["ok"])
+                merged["failed"].extend(result["failed"])
+        return merged
+
+    def poll_all(self, macs=None):
+        """ReadDevice every MAC, hubs in parallel; returns {mac: reply}"""
+        groups = {}
+        for mac in (self.devices if macs is None else macs):
+            if mac in self.routes:
+                groups.setdefault(self.routes[mac].host, []).append(mac)
+        polled = self._parallel(lambda hub: {mac: hub.get_status(mac) for mac in groups[hub.host]},
+                                [self.hubs[host] for host in groups])
+        return {mac: reply for replies in polled.values() if replies for mac, reply in replies.items() if reply}
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# brel_sim.py - Loopback Brel Home Hub 03/2 simulator
+# Answers GetDeviceList/ReadDevice/WriteDevice on UNICAST_PORT, checks the
+# AccessToken like the real hub and multicasts Report/Gateway messages, so
+# brel_lib.py, plugin.py and the standalone script can run without a hub.
+#
+#   python3 brel_sim.py --devices 40 --latency 0.02 --jitter 0.01 --loss 0.02
+import socket
+import json
+import time
+import threading
+import random
+import heapq
+import argparse
+from brel_crypto import derive_access_token
+
+MULTICAST_IP = "238.0.0.18"
+UNICAST_PORT = 32100
+MULTICAST_PORT = 32101
+KEY = "0123456789abcdef"
+TOKEN = "simtoken00000000"  # 16 bytes, encrypted without padding like the hub
+DEVICE_TYPE = "10000000"
+
+
+class SimMotor:
+    """Blind motor that moves towards its target at speed % per second"""
+    def __init__(self, mac, speed=20.0, rng=random):
+        self.mac = mac
+        self.speed = speed
+        self.position = rng.randint(0, 100)
+        self.angle = rng.randint(0, 180)
+        self.target_position = self.position
+        self.target_angle = self.angle
+        self.battery = rng.randint(1000, 1260)
+        self.charging = 0
+        self.rssi = rng.randint(-85, -45)
+        self.stamp = time.monotonic()
+
+    def advance(self):
+        now = time.monotonic()
+        step = (now - self.stamp) * self.speed
+        self.stamp = now
+        delta = self.target_position - self.position
+        self.position += max(-step, min(step, delta))
+        self.angle = self.target_angle
+        return self.moving
+
+    @property
+    def moving(self):
+        return abs(self.target_position - self.position) > 0.01
+
+    def data(self):
+        return {
+            "type": 1,
+            "operation": 2 if not self.moving else (1 if self.target_position > self.position else 0),
+            "currentPosition": int(round(self.position)),
+            "currentAngle": int(self.angle),
+            "currentState": 3,
+            "voltageMode": 1,
+            "batteryLevel": self.battery,
+            "chargingState": self.charging,
+            "wirelessMode": 1,
+            "RSSI": self.rssi,
+        }
+
+
+class BrelHubSimulator:
+    """Simulated hub bound to host:UNICAST_PORT.
+
+    latency/jitter (seconds) delay every reply, loss drops that fraction of
+    requests. Reports go to report_target, the multicast group by default;
+    pass a unicast address such as ("127.0.0.1", MULTICAST_PORT) when the
+    loopback interface does not carry multicast.
+    """
+    def __init__(self, host="127.0.0.1", key=KEY, devices=10, latency=0.0, jitter=0.0, loss=0.0,
+                 report_target=(MULTICAST_IP, MULTICAST_PORT), report_interval=0.5, speed=20.0, seed=None):
+        self.host = host
+        self.key = key.encode() if isinstance(key, str) else key
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.report_target = report_target
+        self.report_interval = report_interval
+        self.rng = random.Random(seed)
+        self.hub_mac = "".join(f"{b:02x}" for b in socket.inet_aton(host)) + "0001"
+        self.motors = {}
+        # Motor MACs embed the host address so several simulated hubs never collide
+        octets = socket.inet_aton(host)
+        for i in range(devices):
+            mac = f"f0f5{octets[2]:02x}{octets[3]:02x}{i:04x}0002"
+            self.motors[mac] = SimMotor(mac, speed=speed, rng=self.rng)
+        self.access_token = derive_access_token(self.key, TOKEN)
+        self.stats = {"requests": 0, "dropped": 0, "replies": 0, "reports": 0, "token_errors": 0}
+        self._queue = []  # heap of (due, seq, data, addr)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self.sock = None
+        self.report_sock = None
+
+    # ---------- lifecycle ----------
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, UNICAST_PORT))
+        self.sock.settimeout(0.2)
+        self.report_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.report_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.report_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        for target in (self._serve, self._deliver, self._report_loop):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=2)
+        self.sock.close()
+        self.report_sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ---------- unicast ----------
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.stats["requests"] += 1
+            if self.loss and self.rng.random() < self.loss:
+                self.stats["dropped"] += 1
+                continue
+            try:
+                reply = self.handle(json.loads(data.decode()))
+            except (ValueError, KeyError):
+                continue
+            if reply is not None:
+                self._schedule(json.dumps(reply).encode(), addr)
+
+    def _schedule(self, data, addr):
+        delay = self.latency + (self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._queue, (time.monotonic() + max(0.0, delay), self._seq, data, addr))
+            self._cond.notify()
+
+    def _deliver(self):
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._queue and not self._stop.is_set():
+                    self._cond.wait(0.2)
+                if self._stop.is_set():
+                    return
+                due, _, data, addr = self._queue[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._queue)
+            try:
+                self.sock.sendto(data, addr)
+                self.stats["replies"] += 1
+            except OSError:
+                pass
+
+    def handle(self, msg):
+        """Build the reply for one request, None when the hub would stay silent"""
+        msg_type = msg["msgType"]
+        msg_id = msg.get("msgID")
+        if msg_type == "GetDeviceList":
+            devices = [{"mac": self.hub_mac, "deviceType": "02000001"}]
+            devices += [{"mac": mac, "deviceType": DEVICE_TYPE} for mac in self.motors]
+            return {"msgType": "GetDeviceListAck", "msgID": msg_id, "token": TOKEN,
+                    "ProtocolVersion": "0.9", "fwVersion": "sim", "data": devices}
+        if msg.get("mac") == self.hub_mac:
+            return {"msgType": f"{msg_type}Ack", "mac": self.hub_mac, "deviceType": "02000001",
+                    "msgID": msg_id, "data": {"RSSI": -40}}
+        motor = self.motors.get(msg.get("mac"))
+        if motor is None:
+            return None
+        if msg_type == "ReadDevice":
+            motor.advance()
+            return {"msgType": "ReadDeviceAck", "mac": motor.mac, "deviceType": DEVICE_TYPE,
+                    "msgID": msg_id, "data": motor.data()}
+        if msg_type == "WriteDevice":
+            if msg.get("AccessToken") != self.access_token:
+                self.stats["token_errors"] += 1
+                return {"msgType": "WriteDeviceAck", "mac": motor.mac, "deviceType": DEVICE_TYPE,
+                        "msgID": msg_id, "actionResult": "AccessToken error"}
+            motor.advance()
+            data = msg.get("data", {})
+            if "targetPosition" in data:
+                motor.target_position = max(0, min(100, int(data["targetPosition"])))
+            if "targetAngle" in data:
+                motor.target_angle = max(0, min(180, int(data["targetAngle"])))
+            return {"msgType": "WriteDeviceAck", "mac": motor.mac, "deviceType": DEVICE_TYPE,
+                    "msgID": msg_id, "data": motor.data()}
+        return None
+
+    # ---------- multicast ----------
+    def report(self, motor):
+        msg = {"msgType": "Report", "mac": motor.mac, "deviceType": DEVICE_TYPE,
+               "msgID": f"{int(time.time() * 1000)}", "data": motor.data()}
+        self.report_sock.sendto(json.dumps(msg).encode(), self.report_target)
+        self.stats["reports"] += 1
+
+    def gateway(self):
+        msg = {"msgType": "Gateway", "mac": self.hub_mac, "deviceType": "02000001", "data": {"token": TOKEN}}
+        self.report_sock.sendto(json.dumps(msg).encode(), self.report_target)
+
+    def burst_reports(self, count, rate=0):
+        """Send count Reports round-robin over all motors, paced at rate per second (0 = flat out)"""
+        motors = list(self.motors.values())
+        start = time.monotonic()
+        for i in range(count):
+            self.report(motors[i % len(motors)])
+            if rate:
+                ahead = start + (i + 1) / rate - time.monotonic()
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def _report_loop(self):
+        was_moving = set()
+        while not self._stop.wait(self.report_interval):
+            for motor in list(self.motors.values()):
+                moving = motor.advance()
+                # Report while moving and once more on arrival
+                if moving or motor.mac in was_moving:
+                    try:
+                        self.report(motor)
+                    except OSError:
+                        pass
+                if moving:
+                    was_moving.add(motor.mac)
+                else:
+                    was_moving.discard(motor.mac)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated Brel Home Hub 03/2")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--key", default=KEY)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    args = parser.parse_args()
+
+    sim = BrelHubSimulator(args.host, args.key, args.devices, args.latency, args.jitter, args.loss).start()
+    print(f"Simulated Brel hub on {args.host}:{UNICAST_PORT} with {args.devices} devices, key {args.key}")
+    print(f"AccessToken: {sim.access_token}")
+    try:
+        while True:
+            time.sleep(10)
+            sim.gateway()
+            print(sim.stats)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,42 @@
+# brel_state.py - Cached live state of Brel devices, shared by plugin.py and brel_lib.py
+import time
+
+# Live fields cached per device, in DeviceState.values order
+STATE_FIELDS = ("type", "operation", "currentPosition", "currentAngle", "currentState", "voltageMode",
+                "batteryLevel", "chargingState", "wirelessMode", "RSSI")
+STATE_INDEX = {key: index for index, key in enumerate(STATE_FIELDS)}
+
+
+class DeviceState:
+    """Last known live values of one device, fed by Reports and ReadDevice replies.
+
+    Values live in a fixed list indexed like STATE_FIELDS; updated is the
+    monotonic time the values were valid at, and older updates are ignored.
+    """
+    __slots__ = ("mac", "device_type", "values", "updated")
+
+    def __init__(self, mac, device_type=None):
+        self.mac = mac
+        self.device_type = device_type
+        self.values = [None] * len(STATE_FIELDS)
+        self.updated = None
+
+    def update(self, data, at=None):
+        at = time.monotonic() if at is None else at
+        if self.updated is not None and at < self.updated:
+            return False
+        values = self.values
+        for key, value in data.items():
+            index = STATE_INDEX.get(key)
+            if index is not None:
+                values[index] = value
+        self.updated = at
+        return True
+
+    def age(self):
+        return float("inf") if self.updated is None else time.monotonic() - self.updated
+
+    def as_reply(self):
+        """The state shaped like a ReadDeviceAck, marked cached."""
+        return {"msgType": "ReadDeviceAck", "mac": self.mac, "deviceType": self.device_type, "cached": True,
+                "data": {key: value for key, value in zip(STATE_FIELDS, self.values) if value is not None}}
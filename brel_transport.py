@@ -0,0 +1,74 @@
+# brel_transport.py - Request pacing and retransmission shared by plugin.py,
+# brel_lib.py and the standalone script
+import threading
+import time
+
+# Retransmissions per msgType; ReadDevice and GetDeviceList are idempotent
+RETRIES = {"GetDeviceList": 2, "ReadDevice": 3, "WriteDevice": 1}
+
+
+class RttEstimator:
+    """Smoothed RTT/RTTVAR and retransmission timeout per RFC 6298."""
+    def __init__(self, initial_rto=1.0, min_rto=0.1, max_rto=5.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.lock = threading.Lock()
+
+    def sample(self, rtt):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def timeout(self, attempt):
+        """RTO for the given attempt, doubled per retransmission."""
+        return min(self.max_rto, self.rto * (2 ** attempt))
+
+
+class AdaptiveLimiter:
+    """Token bucket plus in-flight window, both tuned AIMD-style.
+
+    Every answered request grows the window and refill rate additively,
+    every timeout halves them, so polling settles at what the hub can take.
+    """
+    def __init__(self, rate=20.0, window=4, min_rate=2.0, max_rate=200.0, max_window=32):
+        self.rate = float(rate)
+        self.window = float(window)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_window = max_window
+        self._tokens = float(window)
+        self._stamp = time.monotonic()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.window, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._in_flight < int(self.window) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.05
+                self._cond.wait(max(wait, 0.001))
+
+    def release(self, ok):
+        with self._cond:
+            self._in_flight -= 1
+            if ok:
+                self.window = min(self.max_window, self.window + 1.0 / self.window)
+                self.rate = min(self.max_rate, self.rate + 1.0)
+            else:
+                self.window = max(1.0, self.window / 2)
+                self.rate = max(self.min_rate, self.rate / 2)
+            self._cond.notify_all()
@@ -35,10 +35,14 @@
     </description>
 
     <params>
-        <param field="Address" label="Last known Hub IP (optional)" width="200px"/>
+        <param field="Address" label="Last known Hub IP(s), comma separated (optional)" width="200px"/>
         <param field="Password" label="Key (16-byte)" width="200px" required="true"/>
         <param field="Mode1" label="Pre-generated AccessToken (optional)" width="200px"/>
-        <param field="Mode2" label="Debug (0/1)" width="50px" default="0"/>
+        <param field="Mode2" label="Debug (0 = off, 1 = log, 2 = packet capture, 3 = both)" width="50px" default="0"/>
+        <param field="Mode3" label="Report coalescing window (ms, 0 = off)" width="50px" default="0"/>
+        <param field="Mode4" label="WriteDevice retries" width="50px" default="1"/>
+        <param field="Mode5" label="Statistics (0 = off, 1 = metrics file, 2 = file + sensors)" width="50px" default="0"/>
+        <param field="Mode6" label="Poll intervals in s (e.g. position=900,battery=3600; 0 = on demand)" width="300px" default=""/>
     </params>
 </plugin>
 
@@ -48,20 +52,212 @@ import socket
 import json
 import threading
 import time
-import binascii
 import re
+import os
+import bisect
+import queue
+from collections import deque
 from datetime import datetime
-from Crypto.Cipher import AES
+from brel_history import TelemetryHistory
+from brel_capture import CaptureWriter, replay, TX, RX, MULTICAST
+from brel_crypto import derive_access_token
+from brel_transport import AdaptiveLimiter, RttEstimator, RETRIES
+from brel_state import DeviceState
 
 UNICAST_PORT = 32100
 MULTICAST_PORT = 32101
 MULTICAST_IP = "238.0.0.18"
+RECV_BUFSIZE = 65535  # GetDeviceList replies of large installations exceed 4 kB
+MULTICAST_RCVBUF = 1024 * 1024
+REPORT_QUEUE_SIZE = 2048
+REPORT_BATCH = 64
+WORKERS = 4  # background tasks (commands, polls, scenes, hub setup) run on this many threads
+WORK_QUEUE = 64  # tasks waiting for a worker; further submissions are refused
+POLL_WORKERS = 8  # ReadDevice readers per hub, further paced by the hub's AdaptiveLimiter
+UNIT_INDEX_FILE = "brel_units.json"
+SNAPSHOT_FILE = "brel_snapshot.json"
+DISCOVERY_RETRY = 60  # seconds before discovery is retried when no hub answered
+CAPTURE_FILE = "brel_capture-%Y%m%d-%H%M%S.bin"  # strftime pattern, written when Mode2 has bit 2 set
+HISTORY_DIR = "history"
+HISTORY_RECORDS = 16384  # records kept per motor (12 bytes each); 0 disables the recorder
+METRICS_FILE = "brel_metrics.prom"
+STATS_INTERVAL = 60  # seconds between metrics file / sensor updates
+STATS_MAC = "stats"  # pseudo MAC under which statistics sensors are indexed
+SCENES_FILE = "brel_scenes.json"
+SCENE_MAC = "scenes"  # pseudo MAC of the scene selector device
+# {scene name: {mac or "*": [position, angle]}}; None leaves that value alone
+DEFAULT_SCENES = {"All open": {"*": [0, None]}, "All closed": {"*": [100, None]}}
+
+# Maximum data age in seconds before a motor is polled (0 = on demand only)
+POLL_INTERVALS = {"currentPosition": 900, "currentAngle": 900, "batteryLevel": 3600, "chargingState": 3600, "RSSI": 3600}
+POLL_FIELD_ALIASES = {"position": "currentPosition", "angle": "currentAngle", "battery": "batteryLevel",
+                      "charging": "chargingState", "rssi": "RSSI"}
+
+# Domoticz devices created per motor: (name prefix, Report/ReadDevice data key, device kwargs)
+DEVICE_FIELDS = (
+    ("Pos", "currentPosition", {"Type": 244, "Subtype": 73, "Switchtype": 13}),
+    ("Angle", "currentAngle", {"Type": 244, "Subtype": 73, "Switchtype": 13}),
+    ("Battery", "batteryLevel", {"Type": 243, "Subtype": 0, "Switchtype": 0}),
+    ("Charging", "chargingState", {"Type": 243, "Subtype": 0, "Switchtype": 0}),
+    ("RSSI", "RSSI", {"Type": 243, "Subtype": 0, "Switchtype": 0}),
+)
+HUB_FIELD = ""
+
+# ---------------------------
+# Latency and loss instrumentation
+# ---------------------------
+class HubStats:
+    """Counters and RTT histograms per msgType and per MAC, plus Report ingestion."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    WINDOW = 512  # RTT samples kept per key for percentiles
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_type = {}
+        self.by_mac = {}
+        self.by_host = {}
+        self.reports = 0
+        self.report_times = deque(maxlen=10000)
+        self.reports_by_mac = {}
+        self.decode_failures = 0
+        self.counters = {}
+        self.gauges = {}
+
+    def _entry(self, table, key):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = {
+                "requests": 0, "timeouts": 0, "retries": 0, "failures": 0,
+                "rtt": deque(maxlen=self.WINDOW), "buckets": [0] * (len(self.BUCKETS) + 1), "rtt_sum": 0.0,
+            }
+        return entry
+
+    def _entries(self, payload, host=None):
+        entries = [self._entry(self.by_type, payload["msgType"])]
+        if payload.get("mac"):
+            entries.append(self._entry(self.by_mac, payload["mac"]))
+        if host:
+            entries.append(self._entry(self.by_host, host))
+        return entries
+
+    def request(self, payload, host=None):
+        with self.lock:
+            for entry in self._entries(payload, host):
+                entry["requests"] += 1
+
+    def attempt(self, payload, attempt, outcome, rtt, host=None):
+        with self.lock:
+            for entry in self._entries(payload, host):
+                if attempt:
+                    entry["retries"] += 1
+                if outcome == "timeout":
+                    entry["timeouts"] += 1
+                elif rtt is not None:
+                    entry["rtt"].append(rtt)
+                    entry["rtt_sum"] += rtt
+                    entry["buckets"][bisect.bisect_left(self.BUCKETS, rtt)] += 1
+
+    def failure(self, payload, host=None):
+        with self.lock:
+            for entry in self._entries(payload, host):
+                entry["failures"] += 1
+
+    def report(self, mac):
+        with self.lock:
+            self.reports += 1
+            self.report_times.append(time.monotonic())
+            self.reports_by_mac[mac] = self.reports_by_mac.get(mac, 0) + 1
+
+    def decode_failure(self):
+        with self.lock:
+            self.decode_failures += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @staticmethod
+    def _summary(entry):
+        ordered = sorted(entry["rtt"])
+        summary = {k: entry[k] for k in ("requests", "timeouts", "retries", "failures")}
+        for p in (50, 95, 99):
+            summary[f"rtt_p{p}_ms"] = round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000, 1) if ordered else None
+        return summary
+
+    def reports_per_second(self, window=60.0):
+        cutoff = time.monotonic() - window
+        with self.lock:
+            recent = sum(1 for t in self.report_times if t >= cutoff)
+        return round(recent / window, 2)
+
+    def snapshot(self):
+        """Plain dict of all counters and RTT percentiles."""
+        rate = self.reports_per_second()
+        with self.lock:
+            return {
+                "msgType": {k: self._summary(v) for k, v in self.by_type.items()},
+                "mac": {k: self._summary(v) for k, v in self.by_mac.items()},
+                "host": {k: self._summary(v) for k, v in self.by_host.items()},
+                "reports": self.reports,
+                "reports_per_s": rate,
+                "reports_by_mac": dict(self.reports_by_mac),
+                "decode_failures": self.decode_failures,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def prometheus(self, host=""):
+        """Prometheus text exposition format, one family per metric name with its # TYPE line.
+
+        Request counters and RTT histograms are broken down per msgType under
+        brel_*, and again per MAC and per hub host under brel_mac_* and
+        brel_host_*, so summing one family never counts a request twice.
+        """
+        lines = []
+        hub = f'hub="{host}"'
+
+        def family(name, kind, samples):
+            if samples:
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(samples)
+
+        rate = self.reports_per_second()
+        with self.lock:
+            for prefix, label, table in (("brel", "msgType", self.by_type), ("brel_mac", "mac", self.by_mac),
+                                         ("brel_host", "host", self.by_host)):
+                entries = sorted(table.items())
+                for name in ("requests", "timeouts", "retries", "failures"):
+                    family(f"{prefix}_{name}_total", "counter",
+                           [f'{prefix}_{name}_total{{{hub},{label}="{key}"}} {entry[name]}' for key, entry in entries])
+                histogram = []
+                for key, entry in entries:
+                    tags = f'{hub},{label}="{key}"'
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS + ("+Inf",), entry["buckets"]):
+                        cumulative += count
+                        histogram.append(f'{prefix}_rtt_seconds_bucket{{{tags},le="{bound}"}} {cumulative}')
+                    histogram.append(f"{prefix}_rtt_seconds_sum{{{tags}}} {entry['rtt_sum']:.6f}")
+                    histogram.append(f"{prefix}_rtt_seconds_count{{{tags}}} {cumulative}")
+                family(f"{prefix}_rtt_seconds", "histogram", histogram)
+            family("brel_reports_total", "counter",
+                   [f'brel_reports_total{{{hub},mac="{mac}"}} {count}' for mac, count in sorted(self.reports_by_mac.items())])
+            family("brel_reports_per_second", "gauge", [f"brel_reports_per_second{{{hub}}} {rate}"])
+            family("brel_decode_failures_total", "counter", [f"brel_decode_failures_total{{{hub}}} {self.decode_failures}"])
+            for name, value in sorted(self.counters.items()):
+                family(f"brel_{name}_total", "counter", [f"brel_{name}_total{{{hub}}} {value}"])
+            for name, value in sorted(self.gauges.items()):
+                family(f"brel_{name}", "gauge", [f"brel_{name}{{{hub}}} {value}"])
+        return "\n".join(lines) + "\n"
 
 # ---------------------------
 # BrelHub Implementation
 # ---------------------------
 class BrelHub:
-    def __init__(self, host, key, secret=None, debug=False):
+    def __init__(self, host, key, secret=None, debug=False, retries=None, stats=None, capture=None):
         self.host = host
         self.key = key.encode()
         self.secret = secret
@@ -69,6 +265,22 @@ class BrelHub:
         self.devices = {}
         self.gateway = None
         self.access_token = None
+        # One long-lived unicast socket per hub; replies are matched to the
+        # waiting caller by msgID so many requests can be in flight at once.
+        self._sock = None
+        self._sock_lock = threading.Lock()
+        self._rx_thread = None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._last_ms = 0
+        self.limiter = AdaptiveLimiter()
+        self.rtt = RttEstimator()
+        self.retries = dict(RETRIES, **(retries or {}))
+        self.on_attempt = None  # callback(payload, attempt, outcome, rtt)
+        self.stats = stats or HubStats()
+        self.state = {}  # mac -> DeviceState
+        self.capture = capture  # CaptureWriter recording every datagram, or None
+        self._poll_pool = None  # WorkerPool of POLL_WORKERS readers, started on the first poll
 
     def _timestamp(self, mac=None):
         base = "101"
@@ -77,67 +289,137 @@ class BrelHub:
             if nums:
                 base = nums[-1]
         ms = int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds() * 1000)
+        # Keep msgIDs unique for requests issued within the same millisecond
+        with self._pending_lock:
+            ms = max(ms, self._last_ms + 1)
+            self._last_ms = ms
         return f"{base}{ms}"
 
-    def discover_hub(self, timeout=5):
-        # Broadcast probe
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.bind(("", 32102))
-            sock.settimeout(timeout)
-            probe = {"msgType": "GetDeviceList", "msgID": self._timestamp()}
-            sock.sendto(json.dumps(probe).encode(), ("255.255.255.255", UNICAST_PORT))
-            data, addr = sock.recvfrom(4096)
-            self.host = addr[0]
-            Domoticz.Log(f"Brel hub discovered via broadcast at {self.host}")
-            sock.close()
-            return self.host
-        except:
-            pass
+    def _ensure_socket(self):
+        with self._sock_lock:
+            if self._sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind(("", 0))
+                sock.settimeout(1.0)
+                self._sock = sock
+                self._rx_thread = threading.Thread(target=self._receive_loop, args=(sock,), daemon=True)
+                self._rx_thread.start()
+            return self._sock
 
-        # Multicast listen
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(("", MULTICAST_PORT))
-            mreq = socket.inet_aton(MULTICAST_IP) + socket.inet_aton("0.0.0.0")
-            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-            sock.settimeout(timeout)
-            start = time.time()
-            while time.time() - start < timeout:
-                try:
-                    data, addr = sock.recvfrom(4096)
-                    msg = json.loads(data.decode("utf-8", errors="ignore"))
-                    if msg.get("msgType") in ("Gateway", "Report"):
-                        self.host = addr[0]
-                        Domoticz.Log(f"Brel hub discovered via multicast at {self.host}")
-                        sock.close()
-                        return self.host
-                except socket.timeout:
-                    pass
-            sock.close()
-        except:
-            pass
+    def _receive_loop(self, sock):
+        while self._sock is sock:
+            try:
+                data, addr = sock.recvfrom(RECV_BUFSIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if self.capture:
+                self.capture.write(RX, addr, data)
+            try:
+                msg = json.loads(data.decode("utf-8", errors="ignore"))
+            except ValueError:
+                self.stats.decode_failure()
+                continue
+            if not isinstance(msg, dict):
+                self.stats.decode_failure()
+                continue
+            if self.debug:
+                Domoticz.Log(f"Brel RX ← {addr} {msg.get('msgType')}")
+            waiter = self._match_pending(msg)
+            if waiter is None:
+                if self.debug:
+                    Domoticz.Log(f"Brel RX unmatched msgID {msg.get('msgID')}")
+                continue
+            waiter["reply"] = msg
+            waiter["at"] = time.monotonic()
+            waiter["event"].set()
+
+    def _transmit(self, sock, raw):
+        sock.sendto(raw, (self.host, UNICAST_PORT))
+        if self.capture:
+            self.capture.write(TX, (self.host, UNICAST_PORT), raw)
+
+    def _match_pending(self, msg):
+        with self._pending_lock:
+            msg_id = msg.get("msgID")
+            if msg_id not in (None, ""):
+                # A msgID we are not waiting for is a late duplicate of an answered request
+                return self._pending.get(str(msg_id))
+            # Some firmware does not echo msgID: fall back to the oldest
+            # outstanding request of the matching type for the same MAC
+            mac = msg.get("mac")
+            msg_type = msg.get("msgType")
+            for waiter in self._pending.values():
+                if waiter["reply"] is None and waiter["mac"] == mac and msg_type == waiter["type"] + "Ack":
+                    return waiter
         return None
 
-    def _send(self, payload, timeout=5):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind(("", 32102))
-        sock.settimeout(timeout)
+    def _send(self, payload, timeout=5, retries=None):
+        """Send payload and wait for its reply, retransmitting after each RTO.
+
+        timeout bounds the whole exchange; retries defaults to the per-msgType policy.
+        """
+        msg_type = payload["msgType"]
+        if retries is None:
+            retries = self.retries.get(msg_type, 0)
+        msg_id = str(payload["msgID"])
+        waiter = {"event": threading.Event(), "reply": None, "mac": payload.get("mac"), "type": msg_type}
+        with self._pending_lock:
+            self._pending[msg_id] = waiter
+        self.stats.request(payload, self.host)
         try:
-            if self.debug:
-                Domoticz.Log(f"Brel TX → {payload['msgType']} @ {self.host}")
-            sock.sendto(json.dumps(payload).encode("utf-8"), (self.host, UNICAST_PORT))
-            data, addr = sock.recvfrom(4096)
-            if self.debug:
-                Domoticz.Log(f"Brel RX ← {addr}")
-            return json.loads(data.decode("utf-8", errors="ignore"))
+            sock = self._ensure_socket()
+            raw = json.dumps(payload).encode("utf-8")
+            deadline = time.monotonic() + timeout
+            for attempt in range(retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait = remaining if attempt == retries else min(self.rtt.timeout(attempt), remaining)
+                if self.debug:
+                    Domoticz.Log(f"Brel TX → {msg_type} @ {self.host} (attempt {attempt + 1})")
+                sent = time.monotonic()
+                self._transmit(sock, raw)
+                if waiter["event"].wait(wait):
+                    rtt = time.monotonic() - sent
+                    # Karn: only unambiguous first attempts feed the estimator
+                    if attempt == 0:
+                        self.rtt.sample(rtt)
+                    self._record_attempt(payload, attempt, "ok", rtt)
+                    return waiter["reply"]
+                self._record_attempt(payload, attempt, "timeout", None)
+            raise socket.timeout(f"timed out after {attempt + 1} attempts")
         except Exception as e:
-            Domoticz.Error(f"Brel UDP error ({payload['msgType']}): {e}")
+            self.stats.failure(payload, self.host)
+            Domoticz.Error(f"Brel UDP error ({msg_type}): {e}")
             return None
         finally:
+            with self._pending_lock:
+                self._pending.pop(msg_id, None)
+
+    def _record_attempt(self, payload, attempt, outcome, rtt):
+        self.stats.attempt(payload, attempt, outcome, rtt, self.host)
+        if self.debug and (outcome != "ok" or attempt):
+            Domoticz.Log(f"Brel {payload['msgType']} {payload.get('mac', '')} attempt {attempt + 1}: {outcome}")
+        if self.on_attempt:
+            self.on_attempt(payload, attempt, outcome, rtt)
+
+    def get_stats(self):
+        return self.stats.snapshot()
+
+    def close(self):
+        with self._sock_lock:
+            sock, self._sock = self._sock, None
+        if sock:
             sock.close()
+        if self._rx_thread:
+            self._rx_thread.join(timeout=2)
+            self._rx_thread = None
+        with self._sock_lock:
+            pool, self._poll_pool = self._poll_pool, None
+        if pool:
+            pool.stop()
 
     def get_device_list(self):
         msg = {"msgType": "GetDeviceList", "msgID": self._timestamp()}
@@ -153,19 +435,17 @@ class BrelHub:
         if self.secret:
             self.access_token = self.secret
             return self.access_token
-        token = self.gateway["token"].encode()
-        cipher = AES.new(self.key, AES.MODE_ECB)
-        encrypted = cipher.encrypt(token)
-        self.access_token = binascii.hexlify(encrypted).decode().upper()
+        # Cached per gateway token, so only a rotated token costs an AES run
+        self.access_token = derive_access_token(self.key, self.gateway["token"])
         return self.access_token
 
-    def set_value(self, mac, P=None, A=None):
+    def _write_msg(self, mac, P=None, A=None):
         payload = {}
         if P is not None:
             payload["targetPosition"] = int(P)
         if A is not None:
             payload["targetAngle"] = int(A)
-        msg = {
+        return {
             "msgType": "WriteDevice",
             "mac": mac,
             "deviceType": self.devices[mac]["deviceType"],
@@ -173,16 +453,849 @@ class BrelHub:
             "data": payload,
             "msgID": self._timestamp(mac)
         }
-        return self._send(msg)
 
-    def get_status(self, mac):
+    def set_value(self, mac, P=None, A=None):
+        return self._send(self._write_msg(mac, P, A))
+
+    def set_many(self, targets, timeout=5, retries=None):
+        """WriteDevice {mac: (P, A)} back-to-back, then collect the acks together.
+
+        Each round resends only the motors that have not acknowledged yet.
+        Returns {"ok": {mac: ack}, "failed": [mac, ...]}.
+        """
+        if retries is None:
+            retries = self.retries.get("WriteDevice", 0)
+        msgs = {mac: self._write_msg(mac, P, A) for mac, (P, A) in targets.items()}
+        raws = {mac: json.dumps(msg).encode("utf-8") for mac, msg in msgs.items()}
+        waiters = {mac: {"event": threading.Event(), "reply": None, "mac": mac, "type": "WriteDevice"} for mac in msgs}
+        with self._pending_lock:
+            for mac, msg in msgs.items():
+                self._pending[str(msg["msgID"])] = waiters[mac]
+        for msg in msgs.values():
+            self.stats.request(msg, self.host)
+        outstanding = list(msgs)
+        try:
+            sock = self._ensure_socket()
+            deadline = time.monotonic() + timeout
+            for attempt in range(retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not outstanding:
+                    break
+                wait = remaining if attempt == retries else min(self.rtt.timeout(attempt), remaining)
+                sent = time.monotonic()
+                for mac in outstanding:
+                    self._transmit(sock, raws[mac])
+                end = sent + wait
+                for mac in outstanding:
+                    waiters[mac]["event"].wait(max(0.0, end - time.monotonic()))
+                stragglers = []
+                for mac in outstanding:
+                    waiter = waiters[mac]
+                    if waiter["event"].is_set():
+                        rtt = waiter["at"] - sent
+                        if attempt == 0:
+                            self.rtt.sample(rtt)
+                        self._record_attempt(msgs[mac], attempt, "ok", rtt)
+                    else:
+                        self._record_attempt(msgs[mac], attempt, "timeout", None)
+                        stragglers.append(mac)
+                outstanding = stragglers
+        except OSError as e:
+            Domoticz.Error(f"Brel UDP error (WriteDevice x{len(msgs)}): {e}")
+        finally:
+            with self._pending_lock:
+                for msg in msgs.values():
+                    self._pending.pop(str(msg["msgID"]), None)
+        for mac in outstanding:
+            self.stats.failure(msgs[mac], self.host)
+        if outstanding:
+            Domoticz.Error(f"Brel: no ack from {len(outstanding)}/{len(msgs)} motors: {outstanding}")
+        return {
+            "ok": {mac: waiters[mac]["reply"] for mac in msgs if mac not in outstanding},
+            "failed": outstanding,
+        }
+
+    def update_state(self, mac, data, at=None):
+        """Feed Report or ReadDevice data into the cached state of mac; False if older than the cache."""
+        state = self.state.get(mac)
+        if state is None:
+            device_type = self.devices.get(mac, {}).get("deviceType")
+            state = self.state.setdefault(mac, DeviceState(mac, device_type))
+        return state.update(data, at)
+
+    def get_status(self, mac, timeout=5, max_age=None, force=False):
+        """ReadDevice reply for mac, served from the cached state when it is at most max_age seconds old."""
+        state = self.state.get(mac)
+        if not force and max_age is not None and state is not None and state.age() <= max_age:
+            self.stats.count("status_cache_hits")
+            return state.as_reply()
         msg = {
             "msgType": "ReadDevice",
             "mac": mac,
             "deviceType": self.devices[mac]["deviceType"],
             "msgID": self._timestamp(mac)
         }
-        return self._send(msg)
+        sent = time.monotonic()
+        reply = self._send(msg, timeout=timeout)
+        if reply and isinstance(reply.get("data"), dict):
+            # The hub sampled the values some time after the request went out
+            self.update_state(mac, reply["data"], at=sent)
+        return reply
+
+    def poll_devices(self, macs, timeout=3):
+        """ReadDevice all macs concurrently on the hub's poll pool, paced by self.limiter; returns {mac: reply}."""
+        queue = list(macs)
+        results = {}
+        lock = threading.Lock()
+        with self._sock_lock:
+            if self._poll_pool is None:
+                self._poll_pool = WorkerPool(workers=POLL_WORKERS, size=POLL_WORKERS, stats=self.stats)
+            pool = self._poll_pool
+
+        def worker(_):
+            while not pool.stop_event.is_set():
+                with lock:
+                    if not queue:
+                        return
+                    mac = queue.pop(0)
+                self.limiter.acquire()
+                data = None
+                try:
+                    data = self.get_status(mac, timeout=timeout)
+                finally:
+                    self.limiter.release(data is not None)
+                if data:
+                    with lock:
+                        results[mac] = data
+
+        pool.map(worker, range(min(len(queue), POLL_WORKERS)))
+        return results
+
+# ---------------------------
+# Hub discovery
+# ---------------------------
+class HubDiscovery:
+    """Background discovery state machine: idle -> discovering -> found | failed.
+
+    The broadcast probe, the multicast Gateway/Report listen and a unicast
+    probe of the configured fallback IPs run concurrently on ephemeral ports.
+    on_found(host, via) fires for the first answer of every hub, so setup can
+    start while the other probes are still listening; on_done(hosts) fires
+    when the window closes.
+    """
+    def __init__(self, fallback_hosts, on_found, on_done=None, timeout=5):
+        self.fallback_hosts = list(fallback_hosts)
+        self.on_found = on_found
+        self.on_done = on_done
+        self.timeout = timeout
+        self.state = "idle"
+        self.hosts = []
+        self.finished = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.state == "discovering":
+                return
+            self.state = "discovering"
+            self.hosts = []
+            self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=2):
+        self.stop_event.set()
+        thread = getattr(self, "thread", None)
+        if thread:
+            thread.join(timeout)
+
+    def _run(self):
+        probes = [threading.Thread(target=self._broadcast, daemon=True),
+                  threading.Thread(target=self._multicast, daemon=True)]
+        if self.fallback_hosts:
+            probes.append(threading.Thread(target=self._unicast, daemon=True))
+        for t in probes:
+            t.start()
+        for t in probes:
+            t.join()
+        with self.lock:
+            self.state = "found" if self.hosts else "failed"
+            self.finished = time.monotonic()
+            hosts = list(self.hosts)
+        if self.on_done:
+            self.on_done(hosts)
+
+    def _found(self, host, via):
+        with self.lock:
+            if host in self.hosts:
+                return
+            self.hosts.append(host)
+        Domoticz.Log(f"Brel hub discovered via {via} at {host}")
+        try:
+            self.on_found(host, via)
+        except Exception as e:
+            Domoticz.Error(f"Brel hub setup error for {host}: {e}")
+
+    def _collect(self, sock, via, accept):
+        end = time.monotonic() + self.timeout
+        while not self.stop_event.is_set():
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(min(remaining, 0.5))
+            try:
+                data, addr = sock.recvfrom(RECV_BUFSIZE)
+            except socket.timeout:
+                continue
+            try:
+                msg = json.loads(data.decode("utf-8", errors="ignore"))
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and accept(msg):
+                self._found(addr[0], via)
+
+    def _probe(self, targets, via, broadcast=False):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                if broadcast:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                probe = json.dumps({"msgType": "GetDeviceList", "msgID": "101" + str(int(time.time() * 1000))}).encode()
+                for target in targets:
+                    sock.sendto(probe, (target, UNICAST_PORT))
+                self._collect(sock, via, lambda msg: "data" in msg or msg.get("msgType") == "GetDeviceListAck")
+            finally:
+                sock.close()
+        except OSError as e:
+            if self.fallback_hosts or broadcast:
+                Domoticz.Debug(f"Brel {via} probe failed: {e}")
+
+    def _broadcast(self):
+        self._probe(["255.255.255.255"], "broadcast", broadcast=True)
+
+    def _unicast(self):
+        self._probe(self.fallback_hosts, "fallback IP")
+
+    def _multicast(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(("", MULTICAST_PORT))
+                mreq = socket.inet_aton(MULTICAST_IP) + socket.inet_aton("0.0.0.0")
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+                self._collect(sock, "multicast", lambda msg: msg.get("msgType") in ("Gateway", "Report"))
+            finally:
+                sock.close()
+        except OSError as e:
+            Domoticz.Debug(f"Brel multicast discovery failed: {e}")
+
+# ---------------------------
+# Multiple hubs
+# ---------------------------
+class BrelHubSet:
+    """Several hubs behind the BrelHub interface, routing each MAC to the hub that owns it.
+
+    All hubs share one key, one HubStats and the retry policy; each keeps its
+    own socket, token, RTT estimate and limiter, and is queried in parallel.
+    """
+    def __init__(self, hosts, key, secret=None, debug=False, retries=None, capture=None):
+        self.key = key
+        self.secret = secret
+        self.debug = debug
+        self.retries = retries
+        self.capture = capture
+        self.stats = HubStats()
+        self.hubs = {}  # host -> BrelHub
+        self.pool = None  # WorkerPool running per-hub calls, started on first use
+        self.pool_lock = threading.Lock()
+        self.routes = {}  # mac -> BrelHub
+        self.devices = {}
+        for host in hosts:
+            self.add_hub(host)
+
+    @property
+    def host(self):
+        return ",".join(self.hubs)
+
+    def add_hub(self, host):
+        hub = self.hubs.get(host)
+        if hub is None:
+            hub = BrelHub(host, self.key, secret=self.secret, debug=self.debug, retries=self.retries,
+                          stats=self.stats, capture=self.capture)
+            self.hubs[host] = hub
+        return hub
+
+    def _parallel(self, fn, hubs=None):
+        hubs = list(self.hubs.values()) if hubs is None else hubs
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = WorkerPool(stats=self.stats)
+            pool = self.pool
+
+        def run(hub):
+            try:
+                return fn(hub)
+            except Exception as e:
+                Domoticz.Error(f"Brel hub {hub.host}: {e}")
+                return None
+
+        return dict(zip((hub.host for hub in hubs), pool.map(run, hubs)))
+
+    def refresh_routes(self):
+        routes = {}
+        devices = {}
+        for hub in self.hubs.values():
+            for mac, dev in hub.devices.items():
+                routes[mac] = hub
+                devices[mac] = dev
+        self.routes = routes
+        self.devices = devices
+
+    def get_device_list(self):
+        results = self._parallel(lambda hub: hub.get_device_list())
+        for host, devices in results.items():
+            if devices is None:
+                Domoticz.Error(f"Brel: no device list from hub {host}")
+        self.refresh_routes()
+        if not any(results.values()):
+            return None
+        return self.devices
+
+    def generate_access_token(self):
+        for hub in self.hubs.values():
+            if hub.gateway:
+                hub.generate_access_token()
+
+    def hub_for(self, mac):
+        hub = self.routes.get(mac)
+        if hub is None:
+            Domoticz.Error(f"Brel: no hub known for {mac}")
+        return hub
+
+    def set_value(self, mac, P=None, A=None):
+        hub = self.hub_for(mac)
+        return hub.set_value(mac, P=P, A=A) if hub else None
+
+    def set_many(self, targets, timeout=5):
+        """Fan out {mac: (P, A)} to the owning hubs in parallel and merge their results."""
+        groups = {}
+        failed = []
+        for mac, target in targets.items():
+            hub = self.hub_for(mac)
+            if hub:
+                groups.setdefault(hub.host, {})[mac] = target
+            else:
+                failed.append(mac)
+        result = {"ok": {}, "failed": failed}
+        replies = self._parallel(lambda hub: hub.set_many(groups[hub.host], timeout=timeout),
+                                 [self.hubs[host] for host in groups])
+        for host, reply in replies.items():
+            if reply is None:
+                result["failed"].extend(groups[host])
+                continue
+            result["ok"].update(reply["ok"])
+            result["failed"].extend(reply["failed"])
+        return result
+
+    def get_status(self, mac, timeout=5, max_age=None, force=False):
+        hub = self.hub_for(mac)
+        return hub.get_status(mac, timeout=timeout, max_age=max_age, force=force) if hub else None
+
+    def update_state(self, mac, data, at=None):
+        hub = self.routes.get(mac)
+        return hub.update_state(mac, data, at) if hub else False
+
+    def poll_devices(self, macs, timeout=3):
+        """Poll every hub's share of macs in parallel; the sweep takes as long as the slowest hub."""
+        groups = {}
+        for mac in macs:
+            hub = self.routes.get(mac)
+            if hub:
+                groups.setdefault(hub.host, []).append(mac)
+        results = {}
+        polled = self._parallel(lambda hub: hub.poll_devices(groups[hub.host], timeout=timeout),
+                                [self.hubs[host] for host in groups])
+        for replies in polled.values():
+            results.update(replies or {})
+        return results
+
+    def dump_state(self):
+        return [{
+            "host": hub.host,
+            "token": (hub.gateway or {}).get("token"),
+            "devices": list(hub.devices.values()),
+            "access_token": hub.access_token,
+        } for hub in self.hubs.values() if hub.devices]
+
+    def load_state(self, entries):
+        for entry in entries:
+            hub = self.add_hub(entry["host"])
+            hub.gateway = {"token": entry.get("token"), "data": entry["devices"]}
+            hub.devices = {d["mac"]: d for d in entry["devices"]}
+            hub.access_token = entry.get("access_token")
+            if not hub.access_token and hub.gateway["token"]:
+                hub.generate_access_token()
+        self.refresh_routes()
+
+    def get_stats(self):
+        return self.stats.snapshot()
+
+    def close(self):
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.stop()
+        for hub in self.hubs.values():
+            hub.close()
+
+# ---------------------------
+# Worker pool
+# ---------------------------
+class WorkerPool:
+    """Fixed set of worker threads fed from a bounded queue.
+
+    submit() never blocks: when the queue is full the task is refused and
+    counted, so command storms cannot pile up threads. A key keeps at most
+    one queued or running task per key, e.g. one poll sweep at a time.
+    """
+    def __init__(self, workers=WORKERS, size=WORK_QUEUE, stats=None):
+        self.tasks = queue.Queue(maxsize=size)
+        self.stats = stats
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, fn, *args, key=None):
+        if self.stop_event.is_set():
+            return False
+        with self.lock:
+            if key is not None:
+                if key in self.keys:
+                    return False
+                self.keys.add(key)
+            try:
+                self.tasks.put_nowait((fn, args, key))
+            except queue.Full:
+                self.keys.discard(key)
+                if self.stats:
+                    self.stats.count("pool_rejected")
+                return False
+        return True
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                fn, args, key = self.tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                fn(*args)
+            except Exception as e:
+                Domoticz.Error(f"Brel worker error in {getattr(fn, '__name__', fn)}: {e}")
+            finally:
+                if key is not None:
+                    with self.lock:
+                        self.keys.discard(key)
+
+    def map(self, fn, items):
+        """Run fn(item) for every item on the workers and wait; returns the results in order.
+
+        An item the full queue refuses runs on the calling thread instead.
+        Returns early with None for unfinished items once the pool is stopped.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        remaining = [len(items)]
+        done = threading.Condition()
+
+        def run(i):
+            try:
+                results[i] = fn(items[i])
+            except Exception as e:
+                Domoticz.Error(f"Brel worker error in {getattr(fn, '__name__', fn)}: {e}")
+            finally:
+                with done:
+                    remaining[0] -= 1
+                    done.notify_all()
+
+        for i in range(len(items)):
+            if not self.submit(run, i):
+                run(i)
+        with done:
+            while remaining[0] and not self.stop_event.is_set():
+                done.wait(0.5)
+        return results
+
+    def stop(self, timeout=5):
+        """Refuse new tasks, drop queued ones and join the workers."""
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+# ---------------------------
+# Per-device command queue
+# ---------------------------
+class CommandQueue:
+    """Collapses commands per MAC to the latest Position/Angle target.
+
+    One dispatcher thread waits merge_window after the first command of a
+    burst, then hands a single WriteDevice with both fields to the worker
+    pool. A MAC is not dispatched again while its previous send runs, so the
+    last command wins and commands for one motor never overtake each other.
+    When the pool is full the target stays pending and is retried.
+    """
+    def __init__(self, send, pool, merge_window=0.15):
+        self.send = send
+        self.pool = pool
+        self.merge_window = merge_window
+        self.pending = {}  # mac -> {"P": ..., "A": ...}
+        self.due = {}  # mac -> monotonic time the pending target is sent
+        self.sending = set()
+        self.cond = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, mac, P=None, A=None):
+        with self.cond:
+            target = self.pending.setdefault(mac, {})
+            if P is not None:
+                target["P"] = P
+            if A is not None:
+                target["A"] = A
+            if mac not in self.due:
+                self.due[mac] = time.monotonic() + self.merge_window
+                self.cond.notify()
+
+    def _dispatch(self):
+        with self.cond:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                for mac in [m for m, due in self.due.items() if due <= now and m not in self.sending]:
+                    target = self.pending.pop(mac)
+                    del self.due[mac]
+                    self.sending.add(mac)
+                    if not self.pool.submit(self._send, mac, target):
+                        # Backpressure: keep the target and try again after another window
+                        self.sending.discard(mac)
+                        self.pending[mac] = target
+                        self.due[mac] = now + self.merge_window
+                waiting = [due for mac, due in self.due.items() if mac not in self.sending]
+                self.cond.wait(max(0.0, min(waiting) - now) if waiting else None)
+
+    def _send(self, mac, target):
+        try:
+            self.send(mac, P=target.get("P"), A=target.get("A"))
+        except Exception as e:
+            Domoticz.Error(f"Command error for {mac}: {e}")
+        finally:
+            with self.cond:
+                self.sending.discard(mac)
+                self.cond.notify()
+
+    def stop(self, timeout=2):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+# ---------------------------
+# Update ordering
+# ---------------------------
+class UpdateOrdering:
+    """Per-MAC gate that drops duplicate and out-of-order updates.
+
+    Reports are ordered among themselves by the hub timestamp in their msgID,
+    so a repeated datagram or one overtaken by a newer Report is refused.
+    Across sources every update is stamped on the local clock: a Report at
+    the time it was received, a ReadDevice reply at the time its request was
+    sent (the msgID from _timestamp), as the hub may have sampled it any time
+    after that. An update stamped before the last accepted one is stale.
+    """
+    CLOCK_RESET = 60000  # ms; a Report this far behind means the hub clock was reset
+
+    def __init__(self):
+        self.last_report = {}  # mac -> (msgID, hub ms) of the newest Report
+        self.last_local = {}  # mac -> local ms of the newest accepted update
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def msg_time(msg_id):
+        """Epoch ms encoded in the last 13 digits of a msgID, None when there is none."""
+        digits = re.sub(r"\D", "", str(msg_id or ""))[-13:]
+        if len(digits) < 13:
+            return None
+        ms = int(digits)
+        return ms if 10 ** 12 <= ms < 10 ** 13 else None
+
+    def report(self, mac, msg_id, received_ms):
+        """'ok', 'duplicate' or 'stale' for a Report received at received_ms."""
+        hub_ms = self.msg_time(msg_id)
+        with self.lock:
+            last = self.last_report.get(mac)
+            if last is not None and msg_id is not None:
+                if str(msg_id) == last[0]:
+                    return "duplicate"
+                if hub_ms is not None and last[1] is not None and last[1] - self.CLOCK_RESET < hub_ms <= last[1]:
+                    return "stale"
+            if received_ms < self.last_local.get(mac, 0):
+                return "stale"
+            self.last_report[mac] = (str(msg_id), hub_ms)
+            self.last_local[mac] = received_ms
+            return "ok"
+
+    def reply(self, mac, msg_id, received_ms):
+        """'ok' or 'stale' for a ReadDevice reply to the request msg_id."""
+        sent_ms = self.msg_time(msg_id) or received_ms
+        with self.lock:
+            if sent_ms < self.last_local.get(mac, 0):
+                return "stale"
+            self.last_local[mac] = sent_ms
+            return "ok"
+
+    def superseded(self, mac, received_ms):
+        """True once an update newer than received_ms was accepted for mac."""
+        with self.lock:
+            return self.last_local.get(mac, 0) > received_ms
+
+    @staticmethod
+    def accept(stats, verdict):
+        if verdict != "ok":
+            stats.count(f"{verdict}_dropped")
+        return verdict == "ok"
+
+# ---------------------------
+# Report-aware poll scheduling
+# ---------------------------
+class PollScheduler:
+    """Tracks per-field freshness per MAC and hands out only stale devices.
+
+    intervals maps a data field to its maximum age in seconds; 0 means the
+    field is only read on demand. Reports reset the age of the fields they
+    carry; a ReadDevice reply resets every scheduled field, since a field
+    missing from a full read (no battery on an AC motor) is not reported by
+    that device at all and must not keep it due forever. A MAC whose read failed is skipped for
+    a delay that doubles per failure, up to the shortest field interval.
+    """
+    def __init__(self, intervals, per_tick=8, retry_delay=30):
+        self.intervals = {k: v for k, v in intervals.items() if v}
+        self.per_tick = per_tick
+        self.retry_delay = retry_delay
+        self.seen_at = {}  # mac -> {field: monotonic time}
+        self.in_flight = set()
+        self.backoff = {}  # mac -> (monotonic time of the next attempt, current delay)
+        self.lock = threading.Lock()
+
+    def track(self, mac):
+        with self.lock:
+            self.seen_at.setdefault(mac, {})
+
+    def seen(self, mac, fields, complete=False):
+        """Stamp the fields carried by a Report, or all scheduled fields when complete"""
+        now = time.monotonic()
+        with self.lock:
+            stamps = self.seen_at.get(mac)
+            if stamps is None:
+                return
+            self.backoff.pop(mac, None)
+            if complete:
+                stamps.update(dict.fromkeys(self.intervals, now))
+            for field, value in fields.items():
+                if value is not None:
+                    stamps[field] = now
+
+    def overdue(self, mac, now):
+        stamps = self.seen_at[mac]
+        return max(now - stamps.get(field, float("-inf")) - interval for field, interval in self.intervals.items())
+
+    def due(self):
+        """Stale MACs, most overdue first, at most per_tick of them; marks them in flight."""
+        now = time.monotonic()
+        with self.lock:
+            if not self.intervals:
+                return []
+            candidates = [(self.overdue(mac, now), mac) for mac in self.seen_at
+                          if mac not in self.in_flight and self.backoff.get(mac, (0, 0))[0] <= now]
+            stale = [mac for lag, mac in sorted(candidates, reverse=True) if lag >= 0][:self.per_tick]
+            self.in_flight.update(stale)
+        return stale
+
+    def done(self, macs):
+        with self.lock:
+            self.in_flight.difference_update(macs)
+
+    def failed(self, mac):
+        """Back off a MAC that did not answer, so it stops crowding out healthy ones."""
+        with self.lock:
+            if mac not in self.seen_at:
+                return
+            cap = max(min(self.intervals.values(), default=0), self.retry_delay)
+            previous = self.backoff.get(mac)
+            delay = self.retry_delay if previous is None else min(previous[1] * 2, cap)
+            self.backoff[mac] = (time.monotonic() + delay, delay)
+
+    @staticmethod
+    def parse(text, defaults):
+        """Parse "position=900,battery=3600" into a {data field: seconds} dict."""
+        intervals = dict(defaults)
+        for item in (text or "").split(","):
+            name, _, value = item.partition("=")
+            field = POLL_FIELD_ALIASES.get(name.strip().lower())
+            if field and value.strip().isdigit():
+                intervals[field] = int(value)
+        return intervals
+
+# ---------------------------
+# Motion tracking
+# ---------------------------
+class Motion:
+    """One commanded move; wait() or add_done_callback() to learn how it ended."""
+    def __init__(self, mac, target_position, target_angle, start_position, eta):
+        self.mac = mac
+        self.target_position = target_position
+        self.target_angle = target_angle
+        self.start_position = start_position
+        self.started = time.monotonic()
+        self.eta = eta  # predicted arrival, monotonic seconds
+        self.last_move = self.started
+        self.position = start_position
+        self.outcome = None  # "arrived", "stalled" or "superseded"
+        self.finished = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Block until the move ends; returns the outcome or None on timeout."""
+        self._event.wait(timeout)
+        return self.outcome
+
+    def add_done_callback(self, fn):
+        """Call fn(motion) when the move ends, right away if it already has."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        self._run_callback(fn)
+
+    def _finish(self, outcome):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.outcome = outcome
+            self.finished = time.monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._run_callback(fn)
+
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception as e:
+            Domoticz.Error(f"Motion callback error for {self.mac}: {e}")
+
+
+class MotionTracker:
+    """Follows Reports after a WriteDevice to detect arrival or a stalled motor.
+
+    Travel speed (% per second) is learned per MAC from completed moves and
+    used to predict arrival times. A motion is stalled once stall_after
+    seconds passed both since its predicted arrival and since it last moved.
+    """
+    def __init__(self, tolerance=1, stall_after=10.0, default_speed=5.0):
+        self.tolerance = tolerance
+        self.stall_after = stall_after
+        self.default_speed = default_speed
+        self.speed = {}  # mac -> learned % per second
+        self.positions = {}  # mac -> last reported position
+        self.angles = {}
+        self.motions = {}  # mac -> active Motion
+        self.on_stall = None  # callback(motion)
+        self.lock = threading.Lock()
+
+    def expect(self, mac, P=None, A=None):
+        with self.lock:
+            start = self.positions.get(mac)
+            previous = self.motions.get(mac)
+            if previous is not None:
+                # A merged follow-up keeps the target field it did not change
+                P = previous.target_position if P is None else P
+                A = previous.target_angle if A is None else A
+            distance = abs(P - start) if P is not None and start is not None else 0
+            eta = time.monotonic() + distance / self.speed.get(mac, self.default_speed)
+            motion = Motion(mac, P, A, start, eta)
+            self.motions[mac] = motion
+        if previous is not None:
+            previous._finish("superseded")
+        self.update(mac, {})
+        return motion
+
+    def update(self, mac, data):
+        position = data.get("currentPosition")
+        angle = data.get("currentAngle")
+        done = None
+        with self.lock:
+            if position is not None:
+                self.positions[mac] = position
+            if angle is not None:
+                self.angles[mac] = angle
+            motion = self.motions.get(mac)
+            if motion is None:
+                return
+            position = self.positions.get(mac)
+            if position is not None and position != motion.position:
+                motion.position = position
+                motion.last_move = time.monotonic()
+            if self._arrived(motion, mac):
+                done = self.motions.pop(mac)
+                self._learn(done)
+        if done:
+            done._finish("arrived")
+
+    def _arrived(self, motion, mac):
+        if motion.target_position is not None:
+            position = self.positions.get(mac)
+            if position is None or abs(position - motion.target_position) > self.tolerance:
+                return False
+        if motion.target_angle is not None:
+            angle = self.angles.get(mac)
+            if angle is None or abs(angle - motion.target_angle) > self.tolerance:
+                return False
+        return True
+
+    def _learn(self, motion):
+        if motion.start_position is None or motion.target_position is None:
+            return
+        elapsed = time.monotonic() - motion.started
+        distance = abs(motion.target_position - motion.start_position)
+        if distance >= 5 and elapsed > 0:
+            speed = distance / elapsed
+            old = self.speed.get(motion.mac)
+            self.speed[motion.mac] = speed if old is None else 0.7 * old + 0.3 * speed
+
+    def check(self):
+        """Flag motions overdue and unmoved for stall_after seconds; call at least once a second."""
+        now = time.monotonic()
+        stalled = []
+        with self.lock:
+            for mac, motion in list(self.motions.items()):
+                if now - max(motion.eta, motion.last_move) >= self.stall_after:
+                    stalled.append(self.motions.pop(mac))
+        for motion in stalled:
+            motion._finish("stalled")
+            if self.on_stall:
+                self.on_stall(motion)
+        return stalled
+
+    def motion(self, mac):
+        return self.motions.get(mac)
 
 # ---------------------------
 # Domoticz Plugin
@@ -190,138 +1303,559 @@ class BrelHub:
 class BasePlugin:
     def onStart(self):
         Domoticz.Log("Brel Plugin starting")
-        self.debug = Parameters["Mode2"] == "1"
-        last_ip = Parameters["Address"]
-        self.last_poll = 0  # last full poll timestamp
+        debug_mode = int(Parameters.get("Mode2") or 0)
+        self.debug = bool(debug_mode & 1)
+        self.capture = None
+        if debug_mode & 2:
+            path = os.path.join(Parameters.get("HomeFolder", ""), time.strftime(CAPTURE_FILE))
+            try:
+                self.capture = CaptureWriter(path, on_error=lambda e: Domoticz.Error(
+                    f"Brel: packet capture stopped: {e}"))
+                Domoticz.Log(f"Brel: capturing packets to {path}")
+            except OSError as e:
+                Domoticz.Error(f"Brel: packet capture disabled: {e}")
+        hosts = [h.strip() for h in Parameters["Address"].split(",") if h.strip()]
+        self.scheduler = PollScheduler(PollScheduler.parse(Parameters.get("Mode6"), POLL_INTERVALS))
+        self.last_values = {}  # (mac, field) -> last sValue written to Domoticz
+        self.coalesce_window = int(Parameters.get("Mode3") or 0) / 1000.0
+        self.coalesce_pending = {}  # mac -> [flush time, newest receive ms, merged Report data]
+        self.coalesce_lock = threading.Lock()
+        self.apply_lock = threading.RLock()  # poll workers and the apply thread both write units
+        self.ordering = UpdateOrdering()
+        self.stats_mode = int(Parameters.get("Mode5") or 0)
+        self.scenes = {}
+        self.last_stats = 0
+        self.load_unit_index()
+        self.history = None
+        if HISTORY_RECORDS:
+            try:
+                self.history = TelemetryHistory(os.path.join(Parameters.get("HomeFolder", ""), HISTORY_DIR),
+                                                HISTORY_RECORDS)
+            except OSError as e:
+                Domoticz.Error(f"Brel: telemetry history disabled: {e}")
 
-        self.hub = BrelHub(
-            host=last_ip,
+        self.hub = BrelHubSet(
+            hosts,
             key=Parameters["Password"],
             secret=Parameters.get("Mode1"),
-            debug=self.debug
+            debug=self.debug,
+            retries={"WriteDevice": int(Parameters.get("Mode4") or RETRIES["WriteDevice"])},
+            capture=self.capture
         )
+        self.motions = MotionTracker()
+        self.motions.on_stall = lambda m: Domoticz.Error(
+            f"Brel: motor {m.mac} stalled at {m.position} (target {m.target_position}/{m.target_angle})")
+        self.stop_event = threading.Event()
+        self.pool = WorkerPool(stats=self.hub.stats)
+        self.commands = CommandQueue(self.send_command, self.pool)
 
-        if not self.hub.discover_hub():
-            if last_ip:
-                Domoticz.Log(f"Using fallback Brel hub IP {last_ip}")
-            else:
-                Domoticz.Error("Brel hub not discovered and no fallback IP set")
-                return
+        self.listening = False
+        self.mcast_sock = None
+        self.setup_failed = {}  # host -> monotonic time its setup failed or was refused
+        self.setup_lock = threading.Lock()
+
+        # Serve from the last known hub state right away; discovery and device
+        # setup always run in the background so onStart never blocks
+        if self.load_snapshot():
+            Domoticz.Log(f"Brel: warm start from snapshot, hubs {self.hub.host}, {len(self.hub.devices)} devices")
+            self.start_listener()
+        # Configured and previously known hubs are probed directly as well
+        self.discovery = HubDiscovery(list(self.hub.hubs), on_found=self.on_hub_found, on_done=self.on_discovery_done)
+        self.discovery.start()
+
+    def on_hub_found(self, host, via=None):
+        self.setup_failed.pop(host, None)
+        if not self.pool.submit(self.setup_hub, host, key=("setup", host)):
+            Domoticz.Error(f"Brel: setup of {host} not started: plugin busy, retrying in {DISCOVERY_RETRY} s")
+            self.setup_failed[host] = time.monotonic()
 
-        devices = self.hub.get_device_list()
+    def on_discovery_done(self, hosts):
+        if not hosts:
+            Domoticz.Error(f"Brel hub not discovered, retrying in {DISCOVERY_RETRY} s")
+
+    def setup_hub(self, host):
+        """Set up one hub; a failed setup is retried from onHeartbeat after DISCOVERY_RETRY."""
+        ok = False
+        try:
+            ok = self._setup_hub(host)
+        finally:
+            if not ok:
+                self.setup_failed[host] = time.monotonic()
+        return ok
+
+    def _setup_hub(self, host):
+        """Fetch devices and token of one hub, then sync Domoticz devices and the snapshot."""
+        hub = self.hub.add_hub(host)
+        known = set(hub.devices)
+        devices = hub.get_device_list()
         if not devices:
-            Domoticz.Error("Brel: Failed to get device list")
-            return
+            Domoticz.Error(f"Brel: Failed to get device list from {host}")
+            return False
 
-        self.hub.generate_access_token()
+        hub.generate_access_token()
+        if known:
+            added = set(devices) - known
+            removed = known - set(devices)
+            if added or removed:
+                Domoticz.Log(f"Brel: device list of {host} changed, added {sorted(added)}, removed {sorted(removed)}")
 
-        # Create Domoticz devices
-        for idx, mac in enumerate(devices, start=1):
-            base = (idx - 1) * 5 + 1
-            if len(mac) < 15:
-                Domoticz.Device(Name=f" {mac}", Unit=base, Type=243, Subtype=24).Create()
-            else:
-                Domoticz.Device(Name=f"Pos {mac}", Unit=base, Type=244, Subtype=73, Switchtype=13).Create()
-                Domoticz.Device(Name=f"Angle {mac}", Unit=base + 1, Type=244, Subtype=73, Switchtype=13).Create()
-                Domoticz.Device(Name=f"Battery {mac}", Unit=base + 2, Type=243, Subtype=0, Switchtype=0).Create()
-                Domoticz.Device(Name=f"Charging {mac}", Unit=base + 3, Type=243, Subtype=0, Switchtype=0).Create()
-                Domoticz.Device(Name=f"RSSI {mac}", Unit=base + 4, Type=243, Subtype=0, Switchtype=0).Create()
+        with self.setup_lock:
+            self.hub.refresh_routes()
+            # Create Domoticz devices
+            for idx, mac in enumerate(self.hub.devices, start=1):
+                base = (idx - 1) * 5 + 1
+                if len(mac) < 15:
+                    self.create_device(mac, HUB_FIELD, f" {mac}", base, {"Type": 243, "Subtype": 24})
+                else:
+                    for offset, (prefix, key, kwargs) in enumerate(DEVICE_FIELDS):
+                        self.create_device(mac, key, f"{prefix} {mac}", base + offset, kwargs)
+                    self.scheduler.track(mac)
+            self.load_scenes()
+            self.save_unit_index()
+            self.save_snapshot()
+            if not self.listening:
+                self.start_listener()
+        return True
 
-        # Start multicast listener
+    def start_listener(self):
+        if self.stop_event.is_set():
+            return
+        self.listening = True
+        self.reports = queue.Queue(maxsize=REPORT_QUEUE_SIZE)
+        self.apply_thread = threading.Thread(target=self.apply_reports, daemon=True)
+        self.apply_thread.start()
         self.mcast_thread = threading.Thread(target=self.listen_multicast, daemon=True)
         self.mcast_thread.start()
 
+    # ---------------------------
+    # Scenes
+    # ---------------------------
+    def load_scenes(self):
+        """Read brel_scenes.json (or the defaults) and keep the scene selector device in sync."""
+        path = os.path.join(Parameters.get("HomeFolder", ""), SCENES_FILE)
+        try:
+            with open(path) as f:
+                self.scenes = json.load(f)
+        except (OSError, ValueError):
+            self.scenes = DEFAULT_SCENES
+        names = list(self.scenes)
+        options = {"LevelActions": "|" * len(names), "LevelNames": "|".join(["Off"] + names),
+                   "LevelOffHidden": "true", "SelectorStyle": "1"}
+        existed = (SCENE_MAC, "selector") in self.units
+        unit = self.create_device(SCENE_MAC, "selector", "Brel Scenes", 240,
+                                  {"Type": 244, "Subtype": 62, "Switchtype": 18, "Options": options})
+        if existed and unit in Devices:
+            dev = Devices[unit]
+            dev.Update(dev.nValue, dev.sValue, Options=options)
+
+    def scene_targets(self, name):
+        targets = {}
+        for mac, (P, A) in self.scenes[name].items():
+            macs = [m for m in self.hub.devices if len(m) >= 15] if mac == "*" else [mac]
+            for m in macs:
+                targets[m] = (P, A)
+        return targets
+
+    def run_scene(self, name):
+        targets = self.scene_targets(name)
+        result = self.hub.set_many(targets)
+        for mac, ack in result["ok"].items():
+            if "actionResult" not in ack:
+                self.motions.expect(mac, *targets[mac])
+        Domoticz.Log(f"Brel scene '{name}': {len(result['ok'])}/{len(targets)} motors acknowledged")
+
+    # ---------------------------
+    # Warm start snapshot
+    # ---------------------------
+    def load_snapshot(self):
+        path = os.path.join(Parameters.get("HomeFolder", ""), SNAPSHOT_FILE)
+        try:
+            with open(path) as f:
+                snap = json.load(f)
+            # Single-hub snapshots keep host/token/devices at the top level
+            entries = [e for e in snap.get("hubs", [snap]) if e.get("host") and e.get("devices")]
+        except (OSError, ValueError, AttributeError):
+            return False
+        if not entries:
+            return False
+        self.hub.load_state(entries)
+        for mac in self.hub.devices:
+            if len(mac) >= 15:
+                self.scheduler.track(mac)
+        return True
+
+    def save_snapshot(self):
+        path = os.path.join(Parameters.get("HomeFolder", ""), SNAPSHOT_FILE)
+        snap = {"hubs": self.hub.dump_state(), "saved": int(time.time())}
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(snap, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            Domoticz.Error(f"Brel: cannot save snapshot: {e}")
+
+    # ---------------------------
+    # (mac, field) -> Unit index
+    # ---------------------------
+    def load_unit_index(self):
+        """Build self.units from the sidecar file, DeviceIDs and, for legacy devices, names."""
+        self.units = {}
+        self.unit_keys = {}
+        path = os.path.join(Parameters.get("HomeFolder", ""), UNIT_INDEX_FILE)
+        try:
+            with open(path) as f:
+                for unit, (mac, key) in json.load(f).items():
+                    if int(unit) in Devices:
+                        self._index_unit(int(unit), mac, key)
+            self.index_dirty = False
+        except (OSError, ValueError):
+            self.index_dirty = True
+
+        for unit, dev in Devices.items():
+            if unit in self.unit_keys:
+                continue
+            device_id = getattr(dev, "DeviceID", "")
+            if ":" in device_id:
+                mac, _, key = device_id.partition(":")
+            else:
+                # Devices created before the index existed: fall back to the name
+                parts = dev.Name.split()
+                if not parts:
+                    continue
+                mac = parts[-1]
+                key = next((k for p, k, _ in DEVICE_FIELDS if p in dev.Name), HUB_FIELD)
+            self._index_unit(unit, mac, key)
+            self.index_dirty = True
+
+    def _index_unit(self, unit, mac, key):
+        self.units[(mac, key)] = unit
+        self.unit_keys[unit] = (mac, key)
+
+    def create_device(self, mac, key, name, unit, kwargs):
+        if (mac, key) in self.units:
+            return self.units[(mac, key)]
+        while unit in Devices or unit in self.unit_keys:
+            unit += 1
+        Domoticz.Device(Name=name, Unit=unit, DeviceID=f"{mac}:{key}", **kwargs).Create()
+        self._index_unit(unit, mac, key)
+        self.index_dirty = True
+        return unit
+
+    def save_unit_index(self):
+        if not self.index_dirty:
+            return
+        path = os.path.join(Parameters.get("HomeFolder", ""), UNIT_INDEX_FILE)
+        try:
+            with open(path, "w") as f:
+                json.dump({str(u): list(mk) for u, mk in self.unit_keys.items()}, f)
+            self.index_dirty = False
+        except OSError as e:
+            Domoticz.Error(f"Brel: cannot save unit index: {e}")
+
+    def apply_values(self, mac, data):
+        """Push Report/ReadDevice data fields into the units indexed for mac, skipping unchanged ones."""
+        with self.apply_lock:
+            for key, value in data.items():
+                if value is None:
+                    continue
+                unit = self.units.get((mac, key))
+                if unit is None or unit not in Devices:
+                    continue
+                value = str(value)
+                last = self.last_values.get((mac, key))
+                if last is None:
+                    last = Devices[unit].sValue
+                if value == last:
+                    continue
+                Devices[unit].Update(0, value)
+                self.last_values[(mac, key)] = value
+
+    def apply_report(self, mac, data, received_ms):
+        """Apply Report data unless a newer poll reply was applied since it was received."""
+        with self.apply_lock:
+            if self.ordering.superseded(mac, received_ms):
+                self.hub.stats.count("stale_dropped")
+                return
+            self.apply_values(mac, data)
+
+    def coalesce_report(self, mac, data, received_ms):
+        """Merge a burst of Reports for mac and apply only the final values after the window."""
+        if self.coalesce_window <= 0:
+            self.apply_report(mac, data, received_ms)
+            return
+        with self.coalesce_lock:
+            pending = self.coalesce_pending.get(mac)
+            if pending is not None:
+                pending[1] = max(pending[1], received_ms)
+                pending[2].update(data)
+                return
+            self.coalesce_pending[mac] = [time.monotonic() + self.coalesce_window, received_ms, dict(data)]
+
+    def _flush_coalesced(self):
+        """Apply coalesced Reports whose window ended; return seconds until the next one is due."""
+        now = time.monotonic()
+        with self.coalesce_lock:
+            ready = [mac for mac, (due, _, _) in self.coalesce_pending.items() if due <= now]
+            flush = [(mac, *self.coalesce_pending.pop(mac)[1:]) for mac in ready]
+            next_due = min((due for due, _, _ in self.coalesce_pending.values()), default=now + 1.0)
+        for mac, received_ms, data in flush:
+            try:
+                self.apply_report(mac, data, received_ms)
+            except Exception as e:
+                Domoticz.Error(f"Report apply error for {mac}: {e}")
+        return min(1.0, max(0.0, next_due - now))
+
     def listen_multicast(self):
+        """Receive stage: drain the socket into self.reports as fast as possible."""
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULTICAST_RCVBUF)
+            sock.settimeout(1.0)
+            self.mcast_sock = sock
             sock.bind(("", MULTICAST_PORT))
             mreq = socket.inet_aton(MULTICAST_IP) + socket.inet_aton("0.0.0.0")
             sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
-            while True:
+            while not self.stop_event.is_set():
                 try:
-                    data, _ = sock.recvfrom(4096)
-                    msg = json.loads(data.decode("utf-8", errors="ignore"))
-                    if msg.get("msgType") != "Report":
-                        continue
-                    mac = msg.get("mac")
-                    d = msg.get("data", {})
-
-                    pos = d.get("currentPosition")
-                    angle = d.get("currentAngle")
-                    battery = d.get("batteryLevel")
-                    charging = d.get("chargingState")
-                    rssi = d.get("RSSI")
-
-                    for unit, dev in Devices.items():
-                        if dev.Name.endswith(mac):
-                            if "Pos" in dev.Name and pos is not None:
-                                dev.Update(0, str(pos))
-                            elif "Angle" in dev.Name and angle is not None:
-                                dev.Update(0, str(angle))
-                            elif "Battery" in dev.Name and battery is not None:
-                                dev.Update(0, str(battery))
-                            elif "Charging" in dev.Name and charging is not None:
-                                dev.Update(0, str(charging))
-                            elif "RSSI" in dev.Name and rssi is not None:
-                                dev.Update(0, str(rssi))
-                except Exception as e:
+                    data, addr = sock.recvfrom(4096)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    if self.stop_event.is_set():
+                        break
                     Domoticz.Error(f"Multicast listener error: {e}")
-                    time.sleep(1)
+                    self.stop_event.wait(1)
+                    continue
+                if self.capture:
+                    self.capture.write(MULTICAST, addr, data)
+                # Cheap pre-filter: only Reports are worth a JSON parse
+                if b"Report" not in data:
+                    self.hub.stats.count("multicast_filtered")
+                    continue
+                try:
+                    self.reports.put_nowait((data, int(time.time() * 1000)))
+                except queue.Full:
+                    self.hub.stats.count("multicast_dropped")
         except Exception as e:
-            Domoticz.Error(f"Multicast listener failed: {e}")
+            if not self.stop_event.is_set():
+                Domoticz.Error(f"Multicast listener failed: {e}")
+
+    def apply_reports(self):
+        """Apply stage: decode queued Reports in batches, keeping the newest data per MAC."""
+        while not self.stop_event.is_set():
+            # Wakes at least once a second, so stalls are flagged without waiting for a heartbeat
+            try:
+                self.motions.check()
+            except Exception as e:
+                Domoticz.Error(f"Motion check error: {e}")
+            try:
+                batch = [self.reports.get(timeout=self._flush_coalesced())]
+            except queue.Empty:
+                continue
+            while len(batch) < REPORT_BATCH:
+                try:
+                    batch.append(self.reports.get_nowait())
+                except queue.Empty:
+                    break
+            self.hub.stats.gauge("multicast_queue_depth", self.reports.qsize())
+            merged = {}
+            for data, received_ms in batch:
+                try:
+                    self._ingest_report(data, received_ms, merged)
+                except Exception as e:
+                    Domoticz.Error(f"Report ingest error: {e}")
+            for mac, (received_ms, fields) in merged.items():
+                try:
+                    self.motions.update(mac, fields)
+                    self.coalesce_report(mac, fields, received_ms)
+                except Exception as e:
+                    Domoticz.Error(f"Report apply error for {mac}: {e}")
+            self.hub.stats.count("multicast_applied", len(merged))
+
+    def _ingest_report(self, data, received_ms, merged):
+        """Decode one queued datagram and merge it into merged[mac] = [receive ms, fields] if it is a fresh Report."""
+        try:
+            msg = json.loads(data.decode("utf-8", errors="ignore"))
+        except ValueError:
+            self.hub.stats.decode_failure()
+            return
+        if not isinstance(msg, dict) or not isinstance(msg.get("data"), dict):
+            self.hub.stats.decode_failure()
+            return
+        if msg.get("msgType") != "Report":
+            self.hub.stats.count("multicast_filtered")
+            return
+        mac = msg.get("mac")
+        fields = msg["data"]
+        self.hub.stats.report(mac)
+        if not self.ordering.accept(self.hub.stats, self.ordering.report(mac, msg.get("msgID"), received_ms)):
+            return
+        self.hub.update_state(mac, fields)
+        self.scheduler.seen(mac, fields)
+        self.record_history(mac, fields)
+        entry = merged.setdefault(mac, [received_ms, {}])
+        entry[0] = max(entry[0], received_ms)
+        entry[1].update(fields)
 
     def onCommand(self, Unit, Command, Level, Hue):
-        threading.Thread(target=self._handle_command, args=(Unit, Command, Level), daemon=True).start()
+        self._handle_command(Unit, Command, Level)
 
     def _handle_command(self, Unit, Command, Level):
         try:
-            dev = Devices[Unit]
-            mac = dev.Name.split()[-1]
+            mac, key = self.unit_keys[Unit]
             if Command == "Set Level":
-                if "Pos" in dev.Name:
-                    self.hub.set_value(mac, P=Level)
-                elif "Angle" in dev.Name:
-                    self.hub.set_value(mac, A=Level)
+                if mac == SCENE_MAC:
+                    names = list(self.scenes)
+                    index = Level // 10 - 1
+                    if 0 <= index < len(names):
+                        Devices[Unit].Update(2, str(Level))
+                        if not self.pool.submit(self.run_scene, names[index], key=("scene", names[index])):
+                            Domoticz.Error(f"Brel scene '{names[index]}' not started: plugin busy")
+                elif key == "currentPosition":
+                    self.commands.submit(mac, P=Level)
+                elif key == "currentAngle":
+                    self.commands.submit(mac, A=Level)
         except Exception as e:
             Domoticz.Error(f"Command error: {e}")
 
+    def send_command(self, mac, P=None, A=None):
+        """WriteDevice and start tracking the move; returns the Motion or None without an ack."""
+        ack = self.hub.set_value(mac, P=P, A=A)
+        if not ack or "actionResult" in ack:
+            return None
+        return self.motions.expect(mac, P, A)
+
+    def record_history(self, mac, data):
+        if self.history is None or mac not in self.hub.devices:
+            return
+        try:
+            self.history.record(mac, data)
+        except (OSError, ValueError) as e:
+            Domoticz.Error(f"Brel: history write failed for {mac}: {e}")
+
     def onHeartbeat(self):
         now = time.time()
-        # Poll all devices every 10 minutes (600 sec)
-        if now - self.last_poll >= 600:
-            self.last_poll = now
-            threading.Thread(target=self.poll_all_devices, daemon=True).start()
+        if self.discovery.state == "failed" and time.monotonic() - self.discovery.finished >= DISCOVERY_RETRY:
+            self.discovery.start()
+        for host, failed in list(self.setup_failed.items()):
+            if time.monotonic() - failed >= DISCOVERY_RETRY:
+                self.on_hub_found(host)
+        # Poll only motors whose data went stale, a few per heartbeat
+        stale = self.scheduler.due()
+        if stale and not self.pool.submit(self.poll_all_devices, stale, key="poll"):
+            self.scheduler.done(stale)
+        if self.capture:
+            self.capture.flush()
+        if self.stats_mode and now - self.last_stats >= STATS_INTERVAL:
+            self.last_stats = now
+            self.publish_stats()
 
-    def poll_all_devices(self):
+    def publish_stats(self):
+        """Write the Prometheus metrics file and, in mode 2, update the stats sensors."""
+        path = os.path.join(Parameters.get("HomeFolder", ""), METRICS_FILE)
         try:
-            for mac, dev_info in self.hub.devices.items():
-                data = self.hub.get_status(mac)
-                if not data:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self.hub.stats.prometheus(self.hub.host or ""))
+            os.replace(tmp, path)
+        except OSError as e:
+            Domoticz.Error(f"Brel: cannot write metrics: {e}")
+        if self.stats_mode < 2:
+            return
+        snap = self.hub.get_stats()
+        values = {"reports_per_s": snap["reports_per_s"], "decode_failures": snap["decode_failures"]}
+        for msg_type in ("ReadDevice", "WriteDevice"):
+            entry = snap["msgType"].get(msg_type, {})
+            values[f"{msg_type}_rtt_p95_ms"] = entry.get("rtt_p95_ms")
+            values[f"{msg_type}_timeouts"] = entry.get("timeouts")
+        for key, value in values.items():
+            if value is None:
+                continue
+            self.create_device(STATS_MAC, key, f"Brel {key}", 200, {"Type": 243, "Subtype": 31})
+            self.save_unit_index()
+            self.apply_values(STATS_MAC, {key: value})
+
+    def replay_capture(self, path, speed=1.0):
+        """Feed a capture file into the running plugin at speed x the captured timing.
+
+        Multicast datagrams enter the Report pipeline like live ones; captured
+        WriteDevice requests for known MACs go through the command queue.
+        """
+        def report(addr, data):
+            try:
+                self.reports.put((data, int(time.time() * 1000)), timeout=1)
+            except queue.Full:
+                self.hub.stats.count("multicast_dropped")
+
+        def command(addr, data):
+            try:
+                msg = json.loads(data.decode("utf-8", errors="ignore"))
+            except ValueError:
+                return
+            if msg.get("msgType") == "WriteDevice" and msg.get("mac") in self.hub.devices:
+                target = msg.get("data", {})
+                self.commands.submit(msg["mac"], P=target.get("targetPosition"), A=target.get("targetAngle"))
+
+        if not self.listening:
+            self.start_listener()
+        return replay(path, {MULTICAST: report, TX: command}, speed, self.stop_event)
+
+    def poll_all_devices(self, macs=None):
+        if macs is None:
+            macs = list(self.hub.devices)
+        try:
+            results = self.hub.poll_devices(macs)
+            received_ms = int(time.time() * 1000)
+            for mac in macs:
+                if not isinstance((results.get(mac) or {}).get("data"), dict):
+                    self.scheduler.failed(mac)
+            for mac, data in results.items():
+                fields = data.get("data")
+                if not isinstance(fields, dict):
                     continue
-                pos = data["data"].get("currentPosition")
-                angle = data["data"].get("currentAngle")
-                battery = data["data"].get("batteryLevel")
-                charging = data["data"].get("chargingState")
-                rssi = data["data"].get("RSSI")
-
-                for unit, dev in Devices.items():
-                    if dev.Name.endswith(mac):
-                        if "Pos" in dev.Name and pos is not None:
-                            dev.Update(0, str(pos))
-                        elif "Angle" in dev.Name and angle is not None:
-                            dev.Update(0, str(angle))
-                        elif "Battery" in dev.Name and battery is not None:
-                            dev.Update(0, str(battery))
-                        elif "Charging" in dev.Name and charging is not None:
-                            dev.Update(0, str(charging))
-                        elif "RSSI" in dev.Name and rssi is not None:
-                            dev.Update(0, str(rssi))
+                # A Report received after this request was sent is newer than the reply;
+                # gate and apply under one lock so a parked Report cannot land in between
+                with self.apply_lock:
+                    if not self.ordering.accept(self.hub.stats,
+                                                self.ordering.reply(mac, data.get("msgID"), received_ms)):
+                        continue
+                    self.apply_values(mac, fields)
+                self.scheduler.seen(mac, fields, complete=True)
+                self.motions.update(mac, fields)
+                self.record_history(mac, fields)
         except Exception as e:
             Domoticz.Error(f"Error polling devices: {e}")
+        finally:
+            self.scheduler.done(macs)
 
     def onStop(self):
+        # Stop every loop, release port 32101 and join the threads so a
+        # restart from the hardware page starts from a clean slate
+        if getattr(self, "stop_event", None):
+            self.stop_event.set()
+        discovery = getattr(self, "discovery", None)
+        if discovery:
+            discovery.stop()
+        if getattr(self, "commands", None):
+            self.commands.stop()
+        if getattr(self, "mcast_sock", None):
+            self.mcast_sock.close()
+        for name in ("mcast_thread", "apply_thread"):
+            thread = getattr(self, name, None)
+            if thread:
+                thread.join(2)
+        if getattr(self, "pool", None):
+            self.pool.stop()
+        hub = getattr(self, "hub", None)
+        if hub:
+            hub.close()
+        if getattr(self, "history", None):
+            self.history.close()
+        if getattr(self, "capture", None):
+            self.capture.close()
         Domoticz.Log("Brel Plugin stopped")
 
 # ---------------------------